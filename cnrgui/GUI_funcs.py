@@ -1,10 +1,22 @@
 #!/usr/bin/env python
 
+import os
+import hashlib
 import numpy as np
+from time import perf_counter
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider, RadioButtons, Button
 from material import Material
-from util import match_energies, cnr
+from util import match_energies, cnr, window_indices
+
+# Sliders saved in session snapshots, by widget attribute prefix
+SESSION_SLIDERS = ('bg_thickness', 'bg_density', 'contrast_thickness',
+                   'contrast_density', 'intensity', 'low_energy', 'high_energy')
+SESSION_VERSION = 1
+
+# Material and bandwidth choices, also checked when restoring a session
+MAT_NAMES = ('H2O', 'Os', 'U', 'Pb')
+BW_OPTIONS = ('1e-2', '1e-4')
 
 
 class Button_Widget(object):
@@ -67,26 +79,78 @@ class GUI(object):
         Sets the dimensions of the GUI figure
     linecolor : str
         Sets the color of the CNR line plot. Choose from matplotlib keywords
+    show_frame_time : bool
+        Displays the time taken to recalculate and redraw the curve after
+        each parameter change
+    progressive : bool
+        Draws a coarse curve (every coarse_step-th energy) before calculating
+        the full curve after each parameter change
+    coarse_step : int
+        Energy subsampling of the coarse curve in progressive mode
+    session : str
+        Snapshot file (.npz). If it exists, the GUI starts from the saved
+        slider values, selections and curve instead of the defaults. The
+        session is saved there when the window is closed
     '''
 
     def __init__(self, thickness_values, bg_density_values, contrast_density_values,
                  max_intensity_value, thickness_units='mm', def_contrast=1, init_max_E=40,
-                 figsize=(14, 8), linecolor='k'):
-
-        mat_names = ['H2O', 'Os', 'U', 'Pb']
+                 figsize=(14, 8), linecolor='k', show_frame_time=False,
+                 progressive=False, coarse_step=8, session=None):
 
         self.nm = False if thickness_units == 'mm' else True
 
+        # CNR is only calculated over the visible energy range
+        self.E_window = (0, init_max_E)
+        self.progressive = progressive
+        self.coarse_step = coarse_step
+
+        # Saved session, with slider values clipped to the current ranges
+        self.session = session
+        state = None if session is None else self.load_session(session)
+        if state is not None:
+            ranges = {'bg_thickness': thickness_values,
+                      'bg_density': bg_density_values,
+                      'contrast_thickness': thickness_values,
+                      'contrast_density': contrast_density_values,
+                      'intensity': (1, max_intensity_value),
+                      'low_energy': (0, 100),
+                      'high_energy': (0, 100)}
+            values = {name: float(np.clip(val, *ranges[name]))
+                      for name, val in zip(SESSION_SLIDERS, state['sliders'])}
+            values['contrast_thickness'] = min(values['contrast_thickness'],
+                                               values['bg_thickness'])
+            def_contrast = MAT_NAMES.index(state['contrast'])
+            self.E_window = (values['low_energy'], values['high_energy'])
+
         # Initial values
-        self.bg = Material(name=mat_names[0],  # background is H2O
+        self.bg = Material(name=MAT_NAMES[0],  # background is H2O
                            thickness=thickness_values.mean() * 3 / 4,
                            density=bg_density_values.mean())
 
-        self.contrast = Material(name=mat_names[def_contrast],
+        self.contrast = Material(name=MAT_NAMES[def_contrast],
                                  thickness=thickness_values.mean() / 4,
                                  density=contrast_density_values.mean())
 
-        match_energies(self.bg, self.contrast)
+        # Slider defaults, restored by reset
+        init = {'bg_thickness': self.bg.thickness,
+                'bg_density': self.bg.density,
+                'contrast_thickness': self.contrast.thickness,
+                'contrast_density': self.contrast.density}
+
+        if state is not None:
+            self.bg.thickness = values['bg_thickness']
+            self.bg.density = values['bg_density']
+            self.contrast.thickness = values['contrast_thickness']
+            self.contrast.density = values['contrast_density']
+
+        # Matched attenuation arrays are reused if the tables are unchanged
+        if state is not None and state['tables'] == self.tables_key():
+            self.bg.E = self.contrast.E = state['E']
+            self.bg.u_p = state['bg_u_p']
+            self.contrast.u_p = state['contrast_u_p']
+        else:
+            match_energies(self.bg, self.contrast)
 
         # Figure properties
         self.fig, self.main_ax = plt.subplots(figsize=figsize)
@@ -94,31 +158,45 @@ class GUI(object):
         self.fig.canvas.set_window_title('MicroCT CNR Calculator')
         self.fig.set_facecolor('lightgray')
 
-        # Default Main Axes properties
-        self.cnr_line, = self.main_ax.plot(
-            self.bg.E, self.get_cnr(), linecolor)
+        # Optional frame time readout, updated after each redraw
+        self.frame_start = None
+        if show_frame_time:
+            self.frame_time_text = self.fig.text(0.93, 0.02, '', ha='right')
+            self.fig.canvas.mpl_connect('draw_event', self.update_frame_time)
+
+        # Default Main Axes properties. The saved curve is reused if none of
+        # its inputs changed
+        if state is None:
+            curve = self.get_cnr()
+        elif (state['tables'] == self.tables_key() and
+              np.array_equal(state['sliders'],
+                             [values[name] for name in SESSION_SLIDERS])):
+            curve = state['curve']
+        else:
+            curve = self.get_cnr(I0=values['intensity'], bw=float(state['bw']))
+        self.cnr_line, = self.main_ax.plot(*curve, linecolor)
         self.main_ax.set_xlabel('E [keV]')
         self.main_ax.set_ylabel('CNR')
         # eqn_abs = r'CNR = $\sqrt{I_0}\left(\frac{\mu}{\rho}\right)_{c}(E)\rho_{c}$ / '
         # eqn_exp = r'$\sqrt{exp\{\left(\frac{\mu}{\rho}\right)_{bg}(E)\rho_{bg} d_{tot}\} + exp\{\left(\frac{\mu}{\rho}\right)_{c}(E)\rho_c d_c + \left(\frac{\mu}{\rho}\right)_{bg}(E)\rho_{bg}d_{tot}\}}$'
         title = r'CNR = $\mu_c$ / $\sqrt{var\{\mu_c\} + var\{\mu_c + \mu_{bg}\}}$'
         self.main_ax.set_title(title)
-        self.main_ax.set_xlim([0, init_max_E])
+        self.main_ax.set_xlim(self.E_window)
         self.main_ax.grid(True)
 
         # Material selection
         self.contrast_mat_widget = Button_Widget(rect=[0.07, 0.70, 0.08, 0.25],
                                                  title='Contrast\n Material',
-                                                 options=(
-                                                       'H2O', 'Os', 'U', 'Pb'),
+                                                 options=MAT_NAMES,
                                                  default=def_contrast,  # Default: Osmium
                                                  update_func=self.update_mat)
 
         # Bandwidth Selection
         self.bandwidth_widget = Button_Widget(rect=[0.20, 0.70, 0.08, 0.25],
                                               title='Energy\n Bandwidth',
-                                              options=('1e-2', '1e-4'),
-                                              default=0,  # Default: H2O
+                                              options=BW_OPTIONS,
+                                              default=0 if state is None else
+                                              BW_OPTIONS.index(state['bw']),
                                               update_func=self.update)
 
         # Background parameters
@@ -126,7 +204,7 @@ class GUI(object):
                                                     title=r'$d_{tot}$',
                                                     low=thickness_values[0],
                                                     high=thickness_values[1],
-                                                    init=self.bg.thickness,
+                                                    init=init['bg_thickness'],
                                                     units='nm' if self.nm else 'mm',
                                                     fmt='%1.0f' if self.nm else '%1.2f',
                                                     sup_title='Background Parameters',
@@ -136,7 +214,7 @@ class GUI(object):
                                                   title=r'$\rho_{bg}$',
                                                   low=bg_density_values[0],
                                                   high=bg_density_values[1],
-                                                  init=self.bg.density,
+                                                  init=init['bg_density'],
                                                   fmt='%1.2f',
                                                   units='g/cc',
                                                   update_func=self.update)
@@ -146,7 +224,7 @@ class GUI(object):
                                                           title=r'$d_{con}$',
                                                           low=thickness_values[0],
                                                           high=thickness_values[1],
-                                                          init=self.contrast.thickness,
+                                                          init=init['contrast_thickness'],
                                                           units='nm' if self.nm else 'mm',
                                                           fmt='%1.0f' if self.nm else '%1.2f',
                                                           sup_title='Contrast Parameters',
@@ -156,7 +234,7 @@ class GUI(object):
                                                         title=r'$\rho_{con}$',
                                                         low=contrast_density_values[0],
                                                         high=contrast_density_values[1],
-                                                        init=self.contrast.density,
+                                                        init=init['contrast_density'],
                                                         units='g/cc',
                                                         update_func=self.update)
 
@@ -205,11 +283,100 @@ class GUI(object):
         button_reset = Button(reset_ax, 'Reset Defaults')
         button_reset.on_clicked(self.reset)
 
+        # Sliders keep their defaults for reset, and are moved to the saved
+        # values without recalculating the curve
+        if state is not None:
+            self.restore_sliders(values)
+        if session is not None:
+            self.fig.canvas.mpl_connect('close_event', self.save_session)
+
         plt.show(block=True)
 
-    def get_cnr(self, I0=1, bw=1e-2):
+    def tables_key(self):
+        '''
+        Returns a digest of the current materials' attenuation tables,
+        identifying the matched arrays and curves computed from them.
+        '''
+        h = hashlib.sha256()
+        for mat in (self.bg, self.contrast):
+            h.update(mat.name.encode())
+            h.update(np.ascontiguousarray(mat.E_raw).tobytes())
+            h.update(np.ascontiguousarray(mat.u_p_raw).tobytes())
+        return h.hexdigest()
+
+    def load_session(self, path):
+        '''
+        Reads a session snapshot written by save_session. Returns None if the
+        file is missing, unreadable, from other thickness units, or does not
+        match the current sliders and options.
+        '''
+        try:
+            with np.load(path) as f:
+                state = {key: f[key] for key in f.files}
+            if int(state['version']) != SESSION_VERSION:
+                return None
+            if bool(state['nm']) != self.nm:
+                return None
+            for key in ('contrast', 'bw', 'tables'):
+                state[key] = str(state[key])
+            E = state['E']
+            if (state['sliders'].shape != (len(SESSION_SLIDERS),)
+                    or state['contrast'] not in MAT_NAMES
+                    or state['bw'] not in BW_OPTIONS
+                    or E.ndim != 1
+                    or state['bg_u_p'].shape != E.shape
+                    or state['contrast_u_p'].shape != E.shape
+                    or state['curve'].ndim != 2
+                    or state['curve'].shape[0] != 2):
+                return None
+        except (OSError, EOFError, KeyError, ValueError):
+            return None
+        return state
+
+    def save_session(self, event=None):
+        '''
+        Saves slider values, selections, matched attenuation arrays and the
+        current curve to the session file. Connected to the figure's close
+        event.
+        '''
+        if self.session is None:
+            return
+        sliders = [getattr(self, name + '_widget').slider.val
+                   for name in SESSION_SLIDERS]
+
+        # Written via a temporary file so an interrupted save keeps the
+        # previous snapshot
+        tmp = self.session + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, version=SESSION_VERSION, nm=self.nm,
+                                contrast=self.contrast.name,
+                                bw=self.bandwidth_widget.button.value_selected,
+                                sliders=np.array(sliders, dtype=float),
+                                tables=self.tables_key(), E=self.bg.E,
+                                bg_u_p=self.bg.u_p,
+                                contrast_u_p=self.contrast.u_p,
+                                curve=np.stack(self.cnr_line.get_data()))
+        os.replace(tmp, self.session)
+
+    def restore_sliders(self, values):
+        '''
+        Moves the sliders to saved values without triggering updates, and
+        applies the slider limits that update and update_x_axis maintain.
+        '''
+        for name in SESSION_SLIDERS:
+            slider = getattr(self, name + '_widget').slider
+            slider.eventson = False
+            slider.set_val(values[name])
+            slider.eventson = True
+
+        self.contrast_thickness_widget.slider.valmax = values['bg_thickness']
+        self.high_energy_widget.slider.valmin = values['low_energy'] + 0.5
+        self.low_energy_widget.slider.valmax = values['high_energy'] - 0.5
+
+    def get_cnr(self, I0=1, bw=1e-2, step=1):
         '''
-        Calls cnrgui.util.cnr function 
+        Calls cnrgui.util.cnr function over the visible energy range.
+        Returns the energies and CNR values.
         '''
 
         # Sets conversion factor from input thickness unit to cm
@@ -219,8 +386,24 @@ class GUI(object):
             conv = 0.1
 
         CNR = cnr(bg=self.bg, contrast=self.contrast,
-                  I0=I0, conv=conv, bw=bw)
-        return CNR
+                  I0=I0, conv=conv, bw=bw, E_window=self.E_window, step=step)
+        E = self.bg.E[window_indices(self.bg.E, self.E_window, step)]
+        return E, CNR
+
+    def plot_cnr(self, I0=1, bw=1e-2):
+        '''
+        Recalculates the CNR curve. In progressive mode, a coarse curve is
+        drawn first.
+        '''
+        if self.progressive:
+            self.cnr_line.set_data(*self.get_cnr(I0=I0, bw=bw,
+                                                 step=self.coarse_step))
+            self.update_y_axis()
+            self.fig.canvas.draw()
+            self.fig.canvas.flush_events()
+
+        self.cnr_line.set_data(*self.get_cnr(I0=I0, bw=bw))
+        self.update_y_axis()
 
     def update(self, value):
         '''
@@ -229,6 +412,8 @@ class GUI(object):
         parameters.
         '''
 
+        self.frame_start = perf_counter()
+
         # In the case that the background thickness is set to be smaller than the
         # contrast thickness, this sets them to be equal. This way, it updates
         # both thicknesses in real time as the user slides the total thickness
@@ -252,16 +437,11 @@ class GUI(object):
         intensity = self.intensity_widget.slider.val
         bw = float(self.bandwidth_widget.button.value_selected)
 
-        try:
-            # Recalculates CNR
-            self.cnr_line.set_ydata(self.get_cnr(I0=intensity, bw=bw))
-            self.update_y_axis()  # Updates y-axis limits
-            # Resests optimal energy display to blank
-            self.E_opt_text.set_text('')
-            self.fig.canvas.draw_idle()  # Redraws curve
-        except ValueError:
-            # Things blow up when the thicknesses are equal
-            pass
+        # Recalculates CNR and updates y-axis limits
+        self.plot_cnr(I0=intensity, bw=bw)
+        # Resests optimal energy display to blank
+        self.E_opt_text.set_text('')
+        self.fig.canvas.draw_idle()  # Redraws curve
 
     def update_mat(self, val):
         '''
@@ -269,6 +449,8 @@ class GUI(object):
         selection by the user.
         '''
 
+        self.frame_start = perf_counter()
+
         # Updates name, E and u_p attributes of contrast material,
         # keeps other parameters fixed
         self.contrast.change_mat(
@@ -278,13 +460,24 @@ class GUI(object):
         match_energies(self.bg, self.contrast)
 
         # Resets plotted data
-        self.cnr_line.set_xdata(self.bg.E)
-        self.cnr_line.set_ydata(self.get_cnr())
-        self.update_y_axis()
+        self.plot_cnr()
         self.E_opt_text.set_text('')
 
         self.fig.canvas.draw_idle()
 
+    def update_frame_time(self, event):
+        '''
+        Displays the time from the last parameter change to the end of the
+        redraw it triggered.
+        '''
+        if self.frame_start is None:
+            return
+        frame_time = perf_counter() - self.frame_start
+        self.frame_start = None  # The redraw below is not timed
+        self.frame_time_text.set_text(
+            'Frame time: {:.1f} ms'.format(frame_time * 1e3))
+        self.fig.canvas.draw_idle()
+
     def update_y_axis(self):
         '''
         Updates the CNR axis limits so that the curve is fully contained in the axes.
@@ -296,6 +489,8 @@ class GUI(object):
            the upper limit is set to 5% greater than the maximum CNR.
         '''
         ydata = self.cnr_line.get_ydata()
+        if ydata.size == 0:
+            return
         data_ymax = ydata.max()
         axis_ymax = self.main_ax.get_ylim()[-1]
 
@@ -306,9 +501,12 @@ class GUI(object):
 
     def update_x_axis(self, val):
         '''
-        Resets the maximum energy axis value in response to change in slider.
+        Resets the maximum energy axis value in response to change in slider,
+        and recalculates the curve over the new energy range.
         '''
 
+        self.frame_start = perf_counter()
+
         E_max = self.high_energy_widget.slider.val
         E_min = self.low_energy_widget.slider.val
         width = 0.5
@@ -319,6 +517,10 @@ class GUI(object):
         self.main_ax.set_xlim(
             [self.low_energy_widget.slider.val, self.high_energy_widget.slider.val])
 
+        self.E_window = tuple(self.main_ax.get_xlim())
+        self.plot_cnr(I0=self.intensity_widget.slider.val,
+                      bw=float(self.bandwidth_widget.button.value_selected))
+
         self.E_opt_text.set_text('')
         self.fig.canvas.draw_idle()
 
@@ -332,8 +534,14 @@ class GUI(object):
         ydata = self.cnr_line.get_ydata()
         xdata = self.cnr_line.get_xdata()
 
-        ymax = ydata[(xdata >= E_low) & (xdata <= E_high)].max()
-        Emax = xdata[ydata == ymax][0]
+        visible = (xdata >= E_low) & (xdata <= E_high)
+        if not visible.any():
+            # No tabulated energy between the axis limits
+            self.E_opt_text.set_text('-')
+            self.fig.canvas.draw_idle()
+            return
+        ymax = ydata[visible].max()
+        Emax = xdata[visible][ydata[visible] == ymax][0]
         self.E_opt_text.set_text('{} keV'.format(np.round(Emax, 2)))
         self.fig.canvas.draw_idle()
 
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+import os
+import time
+import hashlib
+import tempfile
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: eviction is not serialized between processes
+    fcntl = None
+
+# Version of the cache file format, part of every key
+FORMAT_VERSION = 1
+
+# Age in seconds after which a temporary file is assumed to be left over
+# from an interrupted write
+TMP_MAX_AGE = 3600
+
+
+class CNRCache(object):
+    '''
+    Content-addressed on-disk cache for CNR curves.
+
+    Curves are stored as compressed .npz files named by a hash of the
+    attenuation arrays and all scalar parameters of the computation. The
+    cache is bounded in size: when it grows beyond max_bytes, the least
+    recently used curves are deleted.
+
+    Several processes can share one cache directory. Files are written to a
+    temporary name and atomically renamed into place, so readers never see a
+    partial curve, and eviction is serialized with a lock file.
+
+    The size of the cache is tracked with a running estimate, so the
+    directory is only scanned when the estimate exceeds max_bytes (or every
+    rescan_every writes, to account for other processes). Eviction then
+    removes curves down to 90% of max_bytes.
+
+    Parameters
+    __________
+    path : str
+        Cache directory. Defaults to $CNRGUI_CACHE_DIR, or ~/.cache/cnrgui
+    max_bytes : int
+        Maximum total size of the cached curves, in bytes
+    rescan_every : int
+        Number of writes after which the directory is rescanned even if the
+        size estimate is below max_bytes
+    '''
+
+    def __init__(self, path=None, max_bytes=256 * 2**20, rescan_every=1000):
+        if path is None:
+            path = os.environ.get('CNRGUI_CACHE_DIR',
+                                  os.path.join(os.path.expanduser('~'),
+                                               '.cache', 'cnrgui'))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rescan_every = rescan_every
+        self._size = None  # Unknown until the first scan
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, arrays, **params):
+        '''
+        Returns the hex digest identifying a computation.
+
+        Parameters
+        __________
+        arrays : sequence of ndarray
+            Input arrays (energies, mass attenuations)
+        params : scalars
+            All other parameters of the computation, including a version of
+            the model that produced the value (e.g.
+            cnrgui.util.CNR_MODEL_VERSION). Numbers (Python or
+            numpy, int or float) are hashed as floats, so equal values give
+            the same key whatever their type
+        '''
+        h = hashlib.sha256()
+        h.update('format {}'.format(FORMAT_VERSION).encode())
+        for a in arrays:
+            a = np.ascontiguousarray(a, dtype=float)
+            h.update(str(a.shape).encode())
+            h.update(a.tobytes())
+        params = {name: _normalize(value) for name, value in params.items()}
+        h.update(repr(sorted(params.items())).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        '''
+        Returns the cached curve for key, or None if it is not cached.
+        '''
+        fn = self._filename(key)
+        try:
+            with np.load(fn) as data:
+                value = data['value']
+            # Marks the entry as recently used
+            os.utime(fn)
+        except (FileNotFoundError, KeyError, ValueError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        '''
+        Stores a curve under key, then evicts old curves if the cache may be
+        over its size limit.
+        '''
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, value=value)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, self._filename(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        self._puts += 1
+        if self._size is not None:
+            self._size += size
+        if (self._size is None or self._size > self.max_bytes or
+                self._puts % self.rescan_every == 0):
+            self.evict()
+
+    def evict(self):
+        '''
+        Scans the cache and, if it is larger than max_bytes, deletes least
+        recently used curves until it fits in 90% of max_bytes. Temporary
+        files older than TMP_MAX_AGE, left by interrupted writes, are deleted
+        too.
+        '''
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+            entries = []
+            now = time.time()
+            for fn in os.listdir(self.path):
+                if not fn.endswith(('.npz', '.tmp')):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.path, fn))
+                except FileNotFoundError:
+                    continue
+                if fn.endswith('.npz'):
+                    entries.append((st.st_mtime, st.st_size, fn))
+                elif now - st.st_mtime > TMP_MAX_AGE:
+                    try:
+                        os.remove(os.path.join(self.path, fn))
+                    except FileNotFoundError:
+                        pass
+
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_bytes:
+                for _, size, fn in sorted(entries):
+                    if total <= 0.9 * self.max_bytes:
+                        break
+                    try:
+                        os.remove(os.path.join(self.path, fn))
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+            self._size = total
+
+    def clear(self):
+        '''
+        Deletes all cached curves.
+        '''
+        for fn in os.listdir(self.path):
+            if fn.endswith('.npz'):
+                try:
+                    os.remove(os.path.join(self.path, fn))
+                except FileNotFoundError:
+                    pass
+        self._size = 0
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+
+def _normalize(value):
+    '''
+    Converts numbers in a cache key parameter to float, recursing into
+    lists and tuples
+    '''
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return _normalize(value.tolist())
+    if isinstance(value, (int, float, np.integer, np.floating)) and \
+            not isinstance(value, (bool, np.bool_)):
+        return float(value)
+    return value
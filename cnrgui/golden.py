@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+'''
+Golden reference data for checking that faster implementations of the CNR
+model (get_N, log_interp, match_energies, batch_cnr, ...) give the same
+results as the reference implementation, cnrgui.util.cnr.
+
+The reference curves cover every ordered pair of shipped materials over the
+grid in GRID. They were generated by generate() and are stored in
+cnrgui/golden_data/golden.npz as log(CNR), split into a float32 mantissa in
+[1, 2) and an int32 power of two, so that curves far below the floating
+point range are still compared to float32 precision (~6e-8 relative). This
+takes half the space of float64, but check() tolerances below about 1e-7
+are not meaningful.
+
+An engine is a callable
+
+    engine(bg, contrast, cases) -> (E, CNR)
+
+where bg and contrast are new cnrgui.material.Material objects (energies not
+yet matched), cases is a dict of (K,) arrays with the keys in PARAMETERS,
+and CNR is a (K, E) array of CNR curves along E. Engines are compared with
+
+    python -m cnrgui.golden check --engine batch_cnr
+
+or from Python:
+
+    report = check(my_engine)
+    print(report.summary())
+'''
+
+import sys
+import argparse
+import itertools
+import pkg_resources
+from time import perf_counter
+import numpy as np
+from cnrgui.material import Material
+from cnrgui.util import cnr, match_energies
+from cnrgui.optimize import batch_cnr
+
+GOLDEN_PATH = pkg_resources.resource_filename('cnrgui',
+                                              'golden_data/golden.npz')
+
+MATERIALS = ('H2O', 'Os', 'U', 'Pb')
+
+PARAMETERS = ('bg_thickness', 'bg_density', 'contrast_thickness',
+              'contrast_density', 'I0', 'bw')
+
+# Reference grid. Thicknesses are (background, contrast) pairs in mm
+GRID = {'thickness': ((0.5, 0.05), (2, 0.5)),
+        'bg_density': (1, 2.5),
+        'contrast_density': (0.0025, 0.1),
+        'I0': (1, 1e4),
+        'bw': (0, 1e-4, 1e-2)}
+
+
+class GoldenReport(object):
+    '''
+    Result of comparing an engine to the golden data with
+    cnrgui.golden.check.
+
+    Attributes
+    __________
+    pairs : list of tuple
+        (background, contrast) material names
+    errors : (K,) ndarray
+        Largest relative error of each case
+    pair_index : (K,) ndarray
+        Index into pairs of each case
+    rtol : float
+        Relative tolerance each case was checked against
+    failed : ndarray
+        Indices of the cases exceeding rtol
+    t_engine, t_reference : (P,) ndarray
+        Time (s) taken by the engine and the reference engine for each pair.
+        t_reference is NaN if no reference engine was timed
+    '''
+
+    def __init__(self, pairs, errors, pair_index, rtol, t_engine, t_reference):
+        self.pairs = pairs
+        self.errors = errors
+        self.pair_index = pair_index
+        self.rtol = rtol
+        self.failed = np.flatnonzero(~(errors <= rtol))
+        self.t_engine = t_engine
+        self.t_reference = t_reference
+
+    @property
+    def passed(self):
+        return self.failed.size == 0
+
+    @property
+    def speedup(self):
+        return self.t_reference.sum() / self.t_engine.sum()
+
+    def summary(self):
+        '''
+        Returns a table of errors and timings per material pair.
+        '''
+        lines = ['{:<12s}{:>8s}{:>8s}{:>12s}{:>12s}{:>12s}{:>10s}'.format(
+            'pair', 'cases', 'failed', 'max error', 'time [ms]', 'ref [ms]',
+            'speedup')]
+        for p, (bg, contrast) in enumerate(self.pairs):
+            which = self.pair_index == p
+            lines.append('{:<12s}{:>8d}{:>8d}{:>12.2e}{:>12.1f}{:>12.1f}{:>10.2f}'.format(
+                bg + '/' + contrast, which.sum(),
+                np.isin(np.flatnonzero(which), self.failed).sum(),
+                self.errors[which].max(), self.t_engine[p] * 1e3,
+                self.t_reference[p] * 1e3,
+                self.t_reference[p] / self.t_engine[p]))
+        lines.append('{} of {} cases within rtol={:.1e}, max error {:.2e}, '
+                     'speedup {:.2f}x'.format(
+                         self.errors.size - self.failed.size, self.errors.size,
+                         self.rtol, self.errors.max(), self.speedup))
+        return '\n'.join(lines)
+
+
+def grid_cases():
+    '''
+    Returns the reference cases for one material pair as a dict of (K,)
+    arrays, one per name in PARAMETERS.
+    '''
+    rows = [(d_bg, p_bg, d_c, p_c, I0, bw) for (d_bg, d_c), p_bg, p_c, I0, bw
+            in itertools.product(GRID['thickness'], GRID['bg_density'],
+                                 GRID['contrast_density'], GRID['I0'],
+                                 GRID['bw'])]
+    return dict(zip(PARAMETERS, np.array(rows, dtype=float).T))
+
+
+def cnr_engine(bg, contrast, cases):
+    '''
+    Reference engine: cnrgui.util.cnr, one case at a time.
+    '''
+    match_energies(bg, contrast)
+    CNR = np.empty((cases['bw'].size, bg.E.size))
+    for k in range(cases['bw'].size):
+        bg.thickness = cases['bg_thickness'][k]
+        bg.density = cases['bg_density'][k]
+        contrast.thickness = cases['contrast_thickness'][k]
+        contrast.density = cases['contrast_density'][k]
+        CNR[k] = cnr(bg, contrast, I0=cases['I0'][k], bw=cases['bw'][k])
+    return bg.E, CNR
+
+
+def batch_engine(bg, contrast, cases):
+    '''
+    cnrgui.optimize.batch_cnr, all cases with the same bandwidth at once.
+    '''
+    match_energies(bg, contrast)
+    CNR = np.empty((cases['bw'].size, bg.E.size))
+    for bw in np.unique(cases['bw']):
+        k = cases['bw'] == bw
+        CNR[k] = batch_cnr(bg.E, bg.u_p, contrast.u_p,
+                           cases['bg_thickness'][k], cases['bg_density'][k],
+                           cases['contrast_thickness'][k],
+                           cases['contrast_density'][k], I0=cases['I0'][k],
+                           bw=bw)
+    return bg.E, CNR
+
+
+ENGINES = {'cnr': cnr_engine, 'batch_cnr': batch_engine}
+
+
+def generate(path=GOLDEN_PATH):
+    '''
+    Writes golden data for every material pair from the current
+    implementation of cnrgui.util.cnr. Only needed when the model itself is
+    meant to change.
+    '''
+    cases = grid_cases()
+    pairs = list(itertools.permutations(MATERIALS, 2))
+    E, log_CNR, offsets = [], [], [0]
+    for bg_name, contrast_name in pairs:
+        bg, contrast = Material(bg_name), Material(contrast_name)
+        match_energies(bg, contrast)
+        E.append(bg.E)
+        offsets.append(offsets[-1] + bg.E.size)
+        for k in range(cases['bw'].size):
+            bg.thickness = cases['bg_thickness'][k]
+            bg.density = cases['bg_density'][k]
+            contrast.thickness = cases['contrast_thickness'][k]
+            contrast.density = cases['contrast_density'][k]
+            log_CNR.append(cnr(bg, contrast, I0=cases['I0'][k],
+                               bw=cases['bw'][k], log=True))
+
+    mantissa, exponent = _encode(np.concatenate(log_CNR))
+    np.savez_compressed(path, pairs=np.array(pairs), E=np.concatenate(E),
+                        offsets=np.array(offsets),
+                        cases=np.stack([cases[p] for p in PARAMETERS]),
+                        mantissa=mantissa, exponent=exponent)
+
+
+def load(path=GOLDEN_PATH):
+    '''
+    Reads golden data.
+
+    Returns
+    _______
+    golden : dict
+        {(bg, contrast): (E, cases, log_CNR)}, with cases as returned by
+        grid_cases and log_CNR a (K, E) array
+    '''
+    with np.load(path) as f:
+        pairs = [tuple(p) for p in f['pairs']]
+        offsets = f['offsets']
+        cases = dict(zip(PARAMETERS, f['cases']))
+        log_CNR = _decode(f['mantissa'], f['exponent'])
+        E_all = f['E']
+
+    golden = {}
+    K = cases['bw'].size
+    start = 0
+    for p, pair in enumerate(pairs):
+        E = E_all[offsets[p]:offsets[p + 1]]
+        stop = start + K * E.size
+        golden[pair] = (E, cases, log_CNR[start:stop].reshape(K, E.size))
+        start = stop
+    return golden
+
+
+def check(engine, path=GOLDEN_PATH, rtol=1e-6, reference=cnr_engine):
+    '''
+    Compares an engine to the golden data.
+
+    Relative errors are |CNR / CNR_ref - 1| at every energy. Where CNR_ref
+    underflows double precision, the engine must return a CNR no larger
+    than the smallest normal float.
+
+    Parameters
+    __________
+    engine : callable
+        engine(bg, contrast, cases) -> (E, CNR), see module docstring
+    path : str
+        Golden data file
+    rtol : float
+        Relative tolerance
+    reference : callable
+        Engine timed on the same cases for the speedup. None to skip
+
+    Returns
+    _______
+    report : GoldenReport
+    '''
+    golden = load(path)
+    pairs = list(golden)
+    tiny = np.finfo(float).tiny
+
+    errors, pair_index = [], []
+    t_engine = np.zeros(len(pairs))
+    t_reference = np.full(len(pairs), np.nan)
+    for p, (bg_name, contrast_name) in enumerate(pairs):
+        E_ref, cases, log_ref = golden[(bg_name, contrast_name)]
+
+        t0 = perf_counter()
+        E, CNR = engine(Material(bg_name), Material(contrast_name), cases)
+        t_engine[p] = perf_counter() - t0
+        if reference is not None:
+            t0 = perf_counter()
+            reference(Material(bg_name), Material(contrast_name), cases)
+            t_reference[p] = perf_counter() - t0
+
+        E, CNR = np.asarray(E), np.asarray(CNR)
+        if CNR.shape != log_ref.shape or not np.allclose(E, E_ref, rtol=1e-12):
+            # A different energy axis fails every case
+            errors.append(np.full(log_ref.shape[0], np.inf))
+        else:
+            representable = log_ref > np.log(tiny)
+            with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+                err = np.where(representable,
+                               np.abs(np.exp(np.log(CNR) - log_ref) - 1),
+                               np.where(CNR <= tiny, 0, np.inf))
+            errors.append(np.nan_to_num(err, nan=np.inf).max(axis=-1))
+        pair_index.append(np.full(log_ref.shape[0], p))
+
+    return GoldenReport(pairs, np.concatenate(errors),
+                        np.concatenate(pair_index), rtol, t_engine, t_reference)
+
+
+def _encode(log_CNR):
+    '''
+    Splits log(CNR) into a float32 mantissa in [1, 2) and an int32 exponent,
+    CNR = mantissa * 2**exponent
+    '''
+    exponent = np.floor(log_CNR / np.log(2))
+    mantissa = np.exp(log_CNR - exponent * np.log(2))
+    return mantissa.astype(np.float32), exponent.astype(np.int32)
+
+
+def _decode(mantissa, exponent):
+    '''
+    Returns log(CNR) from _encode output
+    '''
+    return np.log(mantissa.astype(float)) + exponent * np.log(2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CNR golden data')
+    parser.add_argument('command', choices=('check', 'generate'))
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='cnr')
+    parser.add_argument('--rtol', type=float, default=1e-6)
+    parser.add_argument('--path', default=GOLDEN_PATH)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.path)
+    else:
+        report = check(ENGINES[args.engine], args.path, rtol=args.rtol)
+        print(report.summary())
+        sys.exit(0 if report.passed else 1)
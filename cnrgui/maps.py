@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import rotate
+from scipy.special import logsumexp
+from cnrgui.util import get_bw_samples, log_interp
+from cnrgui.profiling import timed
+
+# Largest variance term backprojected per angle, so that sums over angles
+# and interpolation stay finite in float32
+VAR_MAX = np.finfo(np.float32).max / 2**16
+
+
+def path_lengths(volume, n_labels, angle):
+    '''
+    Calculates path lengths through each material along parallel rays.
+
+    Parameters
+    __________
+    volume : (Z, Y, X) ndarray of int
+        Labelled material volume. Label 0 is empty space, label k > 0 is
+        material k - 1. Slices are square (Y == X)
+    n_labels : int
+        Number of material labels, not counting 0
+    angle : float
+        Projection angle in degrees. Rays run along Y after rotating the
+        volume by angle about the Z axis
+
+    Returns
+    _______
+    L : (n_labels, Z, X) ndarray
+        Path length, in voxels, through each material for each detector
+        pixel (row Z, column X)
+    '''
+
+    # Nearest neighbor rotation keeps labels intact
+    rotated = rotate(volume, angle, axes=(1, 2), reshape=False, order=0,
+                     mode='constant', cval=0)
+    return np.stack([(rotated == k + 1).sum(axis=1)
+                     for k in range(n_labels)]).astype(np.float32)
+
+
+def cnr_map(volume, materials, contrast_label, bg_label, E, I0=1, bw=1e-2,
+            voxel_size=1, conv=0.1, n_angles=180, truncate=4, n=50, slab=16,
+            workers=1, out=None):
+    '''
+    Calculates per-voxel CNR of a contrast material over a labelled sample
+    volume, generalizing cnrgui.util.cnr from the central voxel of a
+    homogeneous sphere to arbitrary geometry.
+
+    Following the Spanne noise model, the variance of each reconstructed
+    voxel is proportional to the mean over projection angles of 1/N for the
+    rays through it. As in cnr(), the CNR compares the sample with and
+    without the contrast material:
+
+        CNR(E, x) = u_c(E) / sqrt(mean_theta{1/N1(x)} + mean_theta{1/N2(x)})
+
+    where N2 is computed through the volume as given and N1 through the same
+    volume with contrast_label replaced by bg_label. As in cnr(), the
+    contrast material is dispersed in the background: voxels labelled
+    contrast_label attenuate as the background plus the contrast material.
+
+    The computation streams over projection angles and is chunked into
+    slabs of Z slices, which are independent in parallel-beam geometry. Only
+    one slab is held in memory per worker, and slabs are distributed over
+    processes with workers > 1.
+
+    Parameters
+    __________
+    volume : (Z, Y, X) ndarray of int
+        Labelled material volume. Label 0 is empty space, label k > 0 is
+        materials[k - 1]. Slices must be square (Y == X)
+    materials : list of Material
+        Material for each label, with density set. Thickness is ignored
+    contrast_label : int
+        Label of the contrast material
+    bg_label : int
+        Label of the material the contrast is embedded in
+    E : float or (M,) ndarray
+        Energies, in keV, at which to calculate the maps
+    I0 : int
+        Entrance intensity (number of photons) per ray
+    bw : float
+        Fractional FWHM for intensity spectrum (BW = dE / E)
+    voxel_size : float
+        Voxel edge length, in material thickness units
+    conv : float
+        Conversion factor from voxel_size units to cm
+    n_angles : int
+        Number of projection angles over 180 degrees
+    truncate : int or float
+        Number of standard deviations to include for BW averaging
+    n : int
+        Number of sampling points to use when calculating the Gaussian weights
+        for BW averaging
+    slab : int
+        Number of Z slices processed together
+    workers : int
+        Number of processes
+    out : (M, Z, Y, X) ndarray
+        Optional output array, e.g. a numpy.memmap for volumes too large to
+        hold in memory
+
+    Returns
+    _______
+    CNR : (M, Z, Y, X) ndarray of float32
+        CNR map at each energy. Voxels outside of the circle inscribed in
+        each slice are not seen at every angle and are set to NaN. Rays
+        attenuated so strongly that 1/N exceeds VAR_MAX are clamped to it,
+        so CNR behind them is reported as an upper bound of order
+        u_c / sqrt(VAR_MAX), effectively 0
+    '''
+
+    volume = np.asarray(volume)
+    Z, Y, X = volume.shape
+    if Y != X:
+        raise ValueError('volume slices must be square')
+    E = np.atleast_1d(np.asarray(E, dtype=float))
+
+    # Linear attenuation of every material at the BW sampling energies,
+    # in 1/voxel
+    bounds = (max(m.E_raw.min() for m in materials),
+              min(m.E_raw.max() for m in materials))
+    Ep, G = get_bw_samples(E, bw=bw, truncate=truncate, n=n, bounds=bounds)
+    mu = np.stack([log_interp(m.E_raw, m.u_p_raw, Ep) * m.density
+                   for m in materials]) * voxel_size * conv
+    u_c = log_interp(materials[contrast_label - 1].E_raw,
+                     materials[contrast_label - 1].u_p_raw, E) \
+        * materials[contrast_label - 1].density
+
+    if out is None:
+        out = np.empty((E.size, Z, Y, X), dtype=np.float32)
+
+    angles = np.arange(n_angles) * 180 / n_angles
+    slabs = [slice(z, min(z + slab, Z)) for z in range(0, Z, slab)]
+    args = [(volume[s], mu, G, I0, angles, contrast_label, bg_label)
+            for s in slabs]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(_variance_slab, *zip(*args))
+            for s, var in zip(slabs, results):
+                out[:, s] = var
+    else:
+        for s, a in zip(slabs, args):
+            out[:, s] = _variance_slab(*a)
+
+    # CNR from variance, voxel by voxel
+    for i in range(E.size):
+        with np.errstate(divide='ignore'):
+            out[i] = u_c[i] / np.sqrt(out[i])
+
+    # Voxels outside of the inscribed circle
+    c = (X - 1) / 2
+    yy, xx = np.ogrid[:Y, :X]
+    out[:, :, (yy - c)**2 + (xx - c)**2 > (X / 2)**2] = np.nan
+
+    return out
+
+
+@timed('variance_slab')
+def _variance_slab(volume, mu, G, I0, angles, contrast_label, bg_label):
+    '''
+    Backprojects mean(1/N1 + 1/N2) over all angles for one slab of slices.
+
+    Returns
+    _______
+    var : (M, Zs, Y, X) ndarray of float32
+    '''
+
+    n_labels = mu.shape[0]
+    M = mu.shape[1]
+    Zs, Y, X = volume.shape
+    var = np.zeros((M, Zs, Y, X), dtype=np.float32)
+
+    # Attenuation with and without contrast material in the contrast voxels
+    mu_bg = mu.copy()
+    mu_bg[contrast_label - 1] = mu[bg_label - 1]
+    mu = mu.copy()
+    mu[contrast_label - 1] += mu[bg_label - 1]
+
+    for angle in angles:
+        # Path lengths for every ray in the slab: (n_labels, Zs * X)
+        L = path_lengths(volume, n_labels, angle).reshape(n_labels, -1)
+
+        # log of the photon counts for every ray and energy, averaged over
+        # the BW samples with log-sum-exp as in cnrgui.util.get_logN
+        logN = [np.log(I0) + logsumexp(-np.tensordot(L, m, axes=(0, 0)),
+                                       b=G, axis=-1)  # (rays, M)
+                for m in (mu, mu_bg)]
+
+        # 1/N1 + 1/N2, clamped so that it stays finite
+        invN = np.exp(np.minimum(np.logaddexp(-logN[0], -logN[1]),
+                                 np.log(VAR_MAX)))
+
+        # Smears each detector value back along its ray and rotates back
+        sino = invN.T.reshape(M * Zs, 1, X).astype(np.float32)
+        smear = np.broadcast_to(sino, (M * Zs, Y, X))
+        var += rotate(smear, -angle, axes=(1, 2), reshape=False, order=1,
+                      mode='constant', cval=0).reshape(M, Zs, Y, X)
+
+    return var / len(angles)
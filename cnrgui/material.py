@@ -3,6 +3,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import pkg_resources
+from cnrgui.util import log_interp
 data_path = pkg_resources.resource_filename('cnrgui', 'atten_data/')
 
 
@@ -69,3 +70,198 @@ class Material(object):
 
         data = np.load(fn)
         return data[:, 0], data[:, 1]
+
+
+class MaterialSpec(object):
+    '''
+    Immutable counterpart of Material. Attributes cannot be reassigned and
+    the attenuation arrays are read-only, so a MaterialSpec can be shared
+    between threads without copying. Use replace() to derive a spec with
+    different parameters.
+
+    A MaterialSpec with E and u_p set (e.g. from MaterialSet.spec) can be
+    passed to cnrgui.util.cnr in place of a Material.
+
+    Parameters
+    __________
+    name : str
+        Name of the material ('H2O', 'Os', 'U', 'Pb')
+    thickness : float or int
+        Thickness of material in CNR phantom, assumed to be in mm
+    density : float or integer
+        Density of material in CNR phantom, assumed to be in g/cm3
+    E_raw, u_p_raw : ndarray
+        NIST energies (keV) and mass attenuation (cm2/g). Read from the
+        shipped tables if not given
+    E, u_p : ndarray
+        Energies and mass attenuation on a grid shared with other materials
+    '''
+
+    __slots__ = ('name', 'thickness', 'density', 'E_raw', 'u_p_raw', 'E', 'u_p')
+
+    def __init__(self, name, thickness=1, density=1, E_raw=None, u_p_raw=None,
+                 E=None, u_p=None):
+        if E_raw is None or u_p_raw is None:
+            E_raw, u_p_raw = _read_atten_data(name)
+        values = {'name': name,
+                  'thickness': thickness,
+                  'density': density,
+                  'E_raw': _frozen(E_raw),
+                  'u_p_raw': _frozen(u_p_raw),
+                  'E': _frozen(E),
+                  'u_p': _frozen(u_p)}
+        for attr, value in values.items():
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('MaterialSpec is immutable, use replace()')
+
+    def __delattr__(self, attr):
+        raise AttributeError('MaterialSpec is immutable')
+
+    def __repr__(self):
+        return 'MaterialSpec({!r}, thickness={}, density={})'.format(
+            self.name, self.thickness, self.density)
+
+    def replace(self, **changes):
+        '''
+        Returns a new MaterialSpec with the given attributes changed.
+        Arrays are shared, not copied.
+        '''
+        values = {attr: getattr(self, attr) for attr in self.__slots__}
+        values.update(changes)
+        return MaterialSpec(**values)
+
+
+class MaterialSet(object):
+    '''
+    Mass attenuation of many materials on one shared energy grid, stored as
+    a single read-only 2D array so that sweeps over materials are vectorized
+    and the set can be shared between threads.
+
+    Parameters
+    __________
+    names : sequence of str
+        Material names, one per row of u_p
+    E : (E,) ndarray
+        Shared energy grid in keV
+    u_p : (len(names), E) ndarray
+        Mass attenuation of each material along E, in cm2/g
+    raw : dict
+        {name: (E_raw, u_p_raw)} NIST tables, kept for spec(). Tables that
+        are not given are read when needed
+    '''
+
+    __slots__ = ('names', 'E', 'u_p', '_index', '_raw')
+
+    def __init__(self, names, E, u_p, raw=None):
+        E = _frozen(E)
+        u_p = _frozen(u_p)
+        if u_p.shape != (len(names), E.size):
+            raise ValueError('u_p must have shape (len(names), E.size)')
+        object.__setattr__(self, 'names', tuple(names))
+        object.__setattr__(self, 'E', E)
+        object.__setattr__(self, 'u_p', u_p)
+        object.__setattr__(self, '_index',
+                           {name: i for i, name in enumerate(self.names)})
+        object.__setattr__(self, '_raw', {} if raw is None else
+                           {name: (_frozen(E_raw), _frozen(u_p_raw))
+                            for name, (E_raw, u_p_raw) in raw.items()})
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('MaterialSet is immutable')
+
+    @classmethod
+    def from_names(cls, names, E=None):
+        '''
+        Reads the shipped NIST tables and interpolates them onto a shared
+        grid.
+
+        Parameters
+        __________
+        names : sequence of str
+            Material names
+        E : ndarray
+            Shared energy grid in keV. Defaults to the energies of the most
+            densely sampled material, as in cnrgui.util.match_energies
+        '''
+        tables = [_read_atten_data(name) for name in names]
+        if E is None:
+            E = max(tables, key=lambda t: t[0].size)[0]
+        u_p = np.stack([log_interp(E_raw, u_p_raw, E)
+                        for E_raw, u_p_raw in tables])
+        return cls(names, E, u_p, raw=dict(zip(names, tables)))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getitem__(self, name):
+        '''
+        Returns the mass attenuation row of a material
+        '''
+        return self.u_p[self._index[name]]
+
+    def index(self, names):
+        '''
+        Returns the row index of a name, or an array of indices for a
+        sequence of names
+        '''
+        if isinstance(names, str):
+            return self._index[names]
+        return np.array([self._index[name] for name in names])
+
+    def linear_attenuation(self, density, names=None):
+        '''
+        Returns linear attenuation coefficients (1/cm) for all materials, or
+        the given names, in one vectorized operation.
+
+        Parameters
+        __________
+        density : float or ndarray
+            Density of each material in g/cm3, broadcast against the rows
+        names : sequence of str
+            Materials to include. Defaults to all
+
+        Returns
+        _______
+        u : (n_materials, E) ndarray
+        '''
+        u_p = self.u_p if names is None else self.u_p[self.index(names)]
+        return np.asarray(density, dtype=float)[..., None] * u_p
+
+    def spec(self, name, thickness=1, density=1):
+        '''
+        Returns a MaterialSpec for one material on the shared grid, ready for
+        cnrgui.util.cnr. Shares the set's arrays, without copying or reading
+        files if the set was created by from_names
+        '''
+        E_raw, u_p_raw = self._raw.get(name) or _read_atten_data(name)
+        return MaterialSpec(name, thickness=thickness, density=density,
+                            E_raw=E_raw, u_p_raw=u_p_raw, E=self.E,
+                            u_p=self[name])
+
+
+def _read_atten_data(name):
+    '''
+    Reads the shipped NIST table for a material, returns the energy and
+    mass attenuation columns
+    '''
+    data = np.load(data_path + 'u_p_' + name + '.npy')
+    return data[:, 0], data[:, 1]
+
+
+def _frozen(a):
+    '''
+    Returns a read-only array, copying it if the caller could still modify
+    it through another reference
+    '''
+    if a is None:
+        return None
+    a = np.asarray(a, dtype=float)
+    if a.flags.writeable:
+        a = a.copy()
+        a.flags.writeable = False
+    return a
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+import numpy as np
+from scipy.special import logsumexp
+from cnrgui.util import get_bw_samples, log_resolution_factor
+from cnrgui.profiling import timed
+
+
+class AcquisitionPlan(object):
+    '''
+    Optimal acquisition parameters for a batch of samples, as returned by
+    cnrgui.optimize.optimize_acquisition.
+
+    Attributes
+    __________
+    E : (S,) ndarray
+        Optimal energy in keV for each sample
+    bw : (S,) ndarray
+        Optimal bandwidth setting for each sample
+    I0 : (S,) ndarray
+        Entrance intensity (number of photons) per projection for each
+        sample
+    time : (S,) ndarray
+        Exposure time in seconds for each sample, over all projections. NaN
+        if no flux was given
+    cnr : (S,) ndarray
+        CNR at the optimal parameters for each sample
+    n_evals : int
+        Number of (sample, energy, bandwidth) points at which the CNR model
+        was evaluated
+    '''
+
+    def __init__(self, E, bw, I0, time, cnr, n_evals):
+        self.E = E
+        self.bw = bw
+        self.I0 = I0
+        self.time = time
+        self.cnr = cnr
+        self.n_evals = n_evals
+
+    def __repr__(self):
+        return 'AcquisitionPlan({} samples, {} evaluations)'.format(self.E.size,
+                                                                  self.n_evals)
+
+
+def batch_log_interp(x, y, x_new):
+    '''
+    Log-log linear interpolation and extrapolation, vectorized over a batch
+    of curves sharing the same x values. Equivalent to calling
+    cnrgui.util.log_interp on each curve in turn.
+
+    Parameters
+    __________
+    x : (M,) ndarray
+        Model input, strictly increasing
+    y : (..., M) ndarray
+        Model outputs. Leading dimensions index separate curves
+    x_new : ndarray
+        New model input
+
+    Returns
+    _______
+    new_y : (..., *x_new.shape) ndarray
+        Values interpolated from (x,y) along x_new for each curve
+    '''
+
+    i, w = _log_interp_weights(x, x_new)
+    return _apply_log_interp(y, i, w)
+
+
+def _log_interp_weights(x, x_new):
+    '''
+    Segment indices and weights for log-log linear interpolation of any
+    curve sampled at x onto x_new
+    '''
+
+    logx = np.log(x)
+    logx_new = np.log(x_new)
+
+    # Index of the upper node of the segment containing each new point.
+    # Clipping to the first/last segment gives linear extrapolation.
+    i = np.clip(np.searchsorted(logx, logx_new), 1, logx.size - 1)
+    w = (logx_new - logx[i - 1]) / (logx[i] - logx[i - 1])
+    return i, w
+
+
+def _apply_log_interp(y, i, w):
+    '''
+    Interpolates y with weights from _log_interp_weights
+    '''
+
+    # Zeros (e.g. zero thickness) are floored so they stay finite in log space
+    logy = np.log(np.maximum(y, np.finfo(float).tiny))
+    return np.exp((1 - w) * logy[..., i - 1] + w * logy[..., i])
+
+
+@timed('batch_cnr')
+def batch_cnr(E_vals, u_p_bg, u_p_c, bg_thickness, bg_density,
+              contrast_thickness, contrast_density, I0=1, bw=1e-2, conv=0.1,
+              truncate=4, n=50, scheme='linspace', voxel_size=None,
+              n_projections=1, c_filter=1 / 12, log=False, chunk_size=64):
+    '''
+    Calculates CNR for the two-material model for a batch of samples in one
+    vectorized evaluation. Matches cnrgui.util.cnr sample by sample.
+
+    Parameters
+    __________
+    E_vals : (E,) ndarray
+        Shared energy values, in keV
+    u_p_bg : (E,) or (S, E) ndarray
+        Mass attenuation of the background material along E_vals, in cm2/g
+    u_p_c : (E,) or (S, E) ndarray
+        Mass attenuation of the contrast material along E_vals, in cm2/g
+    bg_thickness, bg_density : float or (S,) ndarray
+        Background thickness and density of each sample
+    contrast_thickness, contrast_density : float or (S,) ndarray
+        Contrast thickness and density of each sample
+    I0 : float or (S,) ndarray
+        Entrance intensity (number of photons)
+    bw : float
+        Fractional FWHM for intensity spectrum (BW = dE / E)
+    conv : float
+        Conversion factor from material thickness units to cm
+    truncate : int or float
+        Number of standard deviations to include for BW averaging
+    n : int
+        Number of sampling points to use when calculating the Gaussian weights
+        for BW averaging
+    scheme : str
+        Quadrature used for BW averaging, 'linspace' or 'hermite'
+    voxel_size : float or (S,) ndarray
+        Voxel size of each sample, in material thickness units. If given,
+        CNR includes the resolution factor of the Spanne noise model, see
+        cnrgui.util.cnr
+    n_projections : int or (S,) ndarray
+        Number of projections of each sample. Only used with voxel_size
+    c_filter : float
+        Variance factor of the reconstruction filter
+    log : bool
+        Returns log(CNR), which stays finite for very strong attenuation
+    chunk_size : int
+        Number of samples evaluated together. Peak memory use is roughly
+        3 * chunk_size * E * n * 8 bytes
+
+    Returns
+    _______
+    CNR : (S, E) ndarray
+        CNR (or log(CNR)) of each sample at each energy in E_vals
+    '''
+
+    E_vals = np.asarray(E_vals, dtype=float)
+    u_p_bg = np.asarray(u_p_bg, dtype=float)
+    u_p_c = np.asarray(u_p_c, dtype=float)
+
+    # Per-sample scalars, as column vectors broadcasting along energy
+    h = 1 if voxel_size is None else voxel_size
+    d_bg, p_bg, d_c, p_c, I0, h, m = [
+        x.reshape(-1, 1) for x in np.broadcast_arrays(
+            *[np.atleast_1d(np.asarray(v, dtype=float)) for v in
+              (bg_thickness, bg_density, contrast_thickness, contrast_density,
+               I0, h, n_projections)])]
+    S = d_bg.shape[0]
+    if u_p_bg.ndim == 2 or u_p_c.ndim == 2:
+        S = max(S, u_p_bg.shape[0] if u_p_bg.ndim == 2 else 1,
+                u_p_c.shape[0] if u_p_c.ndim == 2 else 1)
+        d_bg, p_bg, d_c, p_c, I0, h, m = [np.broadcast_to(x, (S, 1)) for x in
+                                          (d_bg, p_bg, d_c, p_c, I0, h, m)]
+    u_p_bg = np.broadcast_to(u_p_bg, (S, E_vals.size))
+    u_p_c = np.broadcast_to(u_p_c, (S, E_vals.size))
+
+    Ep, G = get_bw_samples(E_vals, bw=bw, truncate=truncate, n=n,
+                           scheme=scheme)
+    i, w = _log_interp_weights(E_vals, Ep)
+
+    CNR = np.empty((S, E_vals.size))
+    for start in range(0, S, chunk_size):
+        s = slice(start, start + chunk_size)
+
+        # Linear attenuation coefficients and attenuation projections
+        u_c = u_p_c[s] * p_c[s]
+        A1 = u_p_bg[s] * p_bg[s] * d_bg[s] * conv
+        A2 = A1 + u_c * d_c[s] * conv
+
+        # Log of the number of photons, averaged over the bandwidth
+        logN1 = np.log(I0[s]) + logsumexp(-_apply_log_interp(A1, i, w),
+                                          b=G, axis=-1)
+        logN2 = np.log(I0[s]) + logsumexp(-_apply_log_interp(A2, i, w),
+                                          b=G, axis=-1)
+
+        # CNR = u_c / sqrt(1/N1 + 1/N2), as in cnrgui.util.cnr
+        with np.errstate(divide='ignore'):  # log(0) = -inf for zero density
+            CNR[s] = np.log(u_c) - 0.5 * np.logaddexp(-logN1, -logN2)
+        if voxel_size is not None:
+            CNR[s] += log_resolution_factor(h[s], m[s], conv=conv,
+                                            c_filter=c_filter)
+
+    return CNR if log else np.exp(CNR)
+
+
+def optimize_acquisition(bg, contrast, bg_thickness=None, bg_density=None,
+                         contrast_thickness=None, contrast_density=None,
+                         bws=(1e-2, 1e-4), I0_max=None, flux=None,
+                         time_budget=None, E_range=None, objective='cnr',
+                         voxel_size=None, n_projections=1, c_filter=1 / 12,
+                         conv=0.1, truncate=4, n=50, scheme='linspace',
+                         chunk_size=64):
+    '''
+    Jointly chooses energy, bandwidth setting and exposure for a batch of
+    samples, maximising CNR under dose and time budgets.
+
+    Because N (and therefore CNR**2) is proportional to I0, the model is only
+    evaluated once per (sample, energy, bandwidth) at unit intensity and then
+    scaled to the largest exposure allowed by the budgets.
+
+    Parameters
+    __________
+    bg : Material
+        Background material, with E and u_p set by
+        cnrgui.util.match_energies
+    contrast : Material
+        Contrast material, with E and u_p matched to bg
+    bg_thickness, bg_density : float or (S,) ndarray
+        Background parameters for each sample. Default to bg.thickness and
+        bg.density
+    contrast_thickness, contrast_density : float or (S,) ndarray
+        Contrast parameters for each sample. Default to contrast.thickness
+        and contrast.density
+    bws : sequence of float
+        Available bandwidth settings (fractional FWHM)
+    I0_max : float or (S,) ndarray
+        Dose budget, as the maximum entrance intensity (number of photons)
+        summed over all projections
+    flux : sequence of float
+        Photons per second delivered with each setting in bws. Required with
+        time_budget or objective='rate'
+    time_budget : float or (S,) ndarray
+        Maximum exposure time in seconds, over all projections
+    E_range : tuple
+        (E_min, E_max) in keV. Restricts the search to this energy window
+    objective : str
+        'cnr' maximises CNR at the allowed exposure. 'rate' maximises
+        CNR**2 per second of exposure, i.e. CNR per unit time
+    voxel_size : float or (S,) ndarray
+        Voxel size of each sample, in material thickness units. If given,
+        CNR includes the resolution factor of the Spanne noise model, see
+        cnrgui.util.cnr
+    n_projections : int or (S,) ndarray
+        Number of projections of each sample. The budgets are shared between
+        projections. Only used with voxel_size
+    c_filter : float
+        Variance factor of the reconstruction filter
+    conv : float
+        Conversion factor from material thickness units to cm
+    truncate : int or float
+        Number of standard deviations to include for BW averaging
+    n : int
+        Number of sampling points to use when calculating the Gaussian weights
+        for BW averaging
+    scheme : str
+        Quadrature used for BW averaging, 'linspace' or 'hermite'
+    chunk_size : int
+        Number of samples evaluated together
+
+    Returns
+    _______
+    plan : AcquisitionPlan
+        Optimal parameters, CNR and the number of model evaluations used
+    '''
+
+    if objective not in ('cnr', 'rate'):
+        raise ValueError("objective must be 'cnr' or 'rate'")
+    if flux is None and (time_budget is not None or objective == 'rate'):
+        raise ValueError('flux is required with time_budget or objective="rate"')
+    if I0_max is None and time_budget is None and objective == 'cnr':
+        raise ValueError('At least one of I0_max and time_budget is required')
+
+    bws = np.atleast_1d(np.asarray(bws, dtype=float))
+    flux = None if flux is None else np.broadcast_to(
+        np.asarray(flux, dtype=float), bws.shape)
+
+    params = [bg.thickness if bg_thickness is None else bg_thickness,
+              bg.density if bg_density is None else bg_density,
+              contrast.thickness if contrast_thickness is None else contrast_thickness,
+              contrast.density if contrast_density is None else contrast_density,
+              np.inf if I0_max is None else I0_max,
+              np.inf if time_budget is None else time_budget,
+              1 if voxel_size is None else voxel_size,
+              1 if voxel_size is None else n_projections]
+    d_bg, p_bg, d_c, p_c, I0_max, t_max, h, m = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(v, dtype=float)) for v in params])
+
+    # Energy window
+    E_vals = bg.E
+    mask = np.ones(E_vals.size, dtype=bool)
+    if E_range is not None:
+        mask = (E_vals >= E_range[0]) & (E_vals <= E_range[1])
+
+    S = d_bg.size
+    score = np.full((bws.size, S), -np.inf)
+    cnr_opt = np.zeros((bws.size, S))
+    E_opt = np.zeros((bws.size, S))
+    I0_opt = np.zeros((bws.size, S))
+    for i, bw in enumerate(bws):
+        # log(CNR) at unit intensity, so that the optimum is still found
+        # when the CNR underflows for very thick samples
+        log_CNR1 = batch_cnr(E_vals, bg.u_p, contrast.u_p, d_bg, p_bg, d_c,
+                             p_c, I0=1, bw=bw, conv=conv, truncate=truncate,
+                             n=n, scheme=scheme,
+                             voxel_size=None if voxel_size is None else h,
+                             n_projections=m, c_filter=c_filter, log=True,
+                             chunk_size=chunk_size)[:, mask]
+        j = log_CNR1.argmax(axis=-1)
+        log_best = log_CNR1[np.arange(S), j]
+        best = np.exp(log_best)
+
+        # Largest exposure per projection allowed by the dose and time
+        # budgets
+        I0 = (I0_max if flux is None else
+              np.minimum(I0_max, flux[i] * t_max)) / m
+
+        E_opt[i] = E_vals[mask][j]
+        I0_opt[i] = I0
+        if objective == 'rate':
+            score[i] = 2 * log_best + np.log(flux[i] / m)
+            # Unbounded budgets have no exposure to report CNR at
+            cnr_opt[i] = np.where(np.isfinite(I0), best * np.sqrt(I0), np.nan)
+        else:
+            cnr_opt[i] = best * np.sqrt(I0)
+            score[i] = log_best + 0.5 * np.log(I0)
+
+    k = score.argmax(axis=0)
+    cols = np.arange(S)
+    time = (np.full(S, np.nan) if flux is None else
+            m * I0_opt[k, cols] / flux[k])
+
+    return AcquisitionPlan(E=E_opt[k, cols],
+                           bw=bws[k],
+                           I0=I0_opt[k, cols],
+                           time=time,
+                           cnr=cnr_opt[k, cols],
+                           n_evals=bws.size * S * E_vals.size)
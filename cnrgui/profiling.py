@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+'''
+Lightweight timing instrumentation for the CNR model.
+
+Stages of the computation are decorated with cnrgui.profiling.timed. While
+profiling is disabled (the default) a decorated function costs one extra
+attribute lookup per call. Profiling is enabled with the profile context
+manager:
+
+    with profile(memory=True) as prof:
+        cnr(bg, contrast)
+    print(prof.summary())
+    prof.dump_chrome_trace('trace.json')
+
+or for a whole process by setting the CNRGUI_PROFILE environment variable.
+If it names a .json file, a Chrome trace (chrome://tracing, Perfetto) is
+written there at exit, otherwise a summary is printed.
+'''
+
+import os
+import sys
+import json
+import atexit
+import threading
+import functools
+import contextlib
+import tracemalloc
+from time import perf_counter
+import numpy as np
+
+
+class Profile(object):
+    '''
+    Collects one event per call of each timed stage.
+
+    Attributes
+    __________
+    events : list of dict
+        One entry per call with keys 'name', 'start' and 'duration' (seconds),
+        'size' (number of elements of the returned array, or None), 'peak'
+        (peak bytes allocated during the call, or None) and 'thread'
+    memory : bool
+        Whether peak allocations are traced (with tracemalloc)
+    '''
+
+    def __init__(self, memory=False):
+        self.events = []
+        self.memory = memory
+        self.t0 = perf_counter()
+
+    def summary(self):
+        '''
+        Returns a table of call counts, wall time, array sizes and peak
+        allocations per stage.
+        '''
+        stages = {}
+        for e in self.events:
+            stages.setdefault(e['name'], []).append(e)
+
+        lines = ['{:<20s}{:>8s}{:>12s}{:>12s}{:>12s}{:>12s}'.format(
+            'stage', 'calls', 'total [ms]', 'mean [ms]', 'max size', 'peak [KiB]')]
+        for name, events in sorted(stages.items(),
+                                   key=lambda x: -sum(e['duration'] for e in x[1])):
+            total = sum(e['duration'] for e in events) * 1e3
+            sizes = [e['size'] for e in events if e['size'] is not None]
+            peaks = [e['peak'] for e in events if e['peak'] is not None]
+            lines.append('{:<20s}{:>8d}{:>12.3f}{:>12.3f}{:>12s}{:>12s}'.format(
+                name, len(events), total, total / len(events),
+                str(max(sizes)) if sizes else '-',
+                '{:.1f}'.format(max(peaks) / 1024) if peaks else '-'))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        '''
+        Returns the events in Chrome trace event format
+        '''
+        events = []
+        for e in self.events:
+            events.append({'name': e['name'],
+                           'ph': 'X',
+                           'ts': (e['start'] - self.t0) * 1e6,
+                           'dur': e['duration'] * 1e6,
+                           'pid': os.getpid(),
+                           'tid': e['thread'],
+                           'args': {'size': e['size'], 'peak': e['peak']}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump_chrome_trace(self, fn):
+        '''
+        Writes the events to fn as Chrome trace JSON
+        '''
+        with open(fn, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+# The active Profile, or None when profiling is disabled
+_active = None
+_local = threading.local()
+
+
+def timed(name):
+    '''
+    Decorator recording each call of the decorated function as stage 'name'
+    of the active Profile.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            prof = _active
+            if prof is None:
+                return func(*args, **kwargs)
+            return _record(prof, name, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def _record(prof, name, func, args, kwargs):
+    '''
+    Calls func, appending its timing to prof.events
+    '''
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+
+    # tracemalloc has one global peak. It is reset for each stage, so the
+    # enclosing stage's peak so far is saved first and merged back after.
+    memory = prof.memory and tracemalloc.is_tracing()
+    if memory:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        frame = {'base': current, 'peak': current}
+        stack.append(frame)
+
+    start = perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        duration = perf_counter() - start
+        peak = None
+        if memory:
+            stack.pop()
+            frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], frame['peak'])
+            peak = frame['peak'] - frame['base']
+
+    # Size of the returned array, or of the first array in a returned tuple
+    out = result[0] if isinstance(result, tuple) and result else result
+    prof.events.append({'name': name,
+                        'start': start,
+                        'duration': duration,
+                        'size': out.size if isinstance(out, np.ndarray) else None,
+                        'peak': peak,
+                        'thread': threading.get_ident()})
+    return result
+
+
+@contextlib.contextmanager
+def profile(memory=False):
+    '''
+    Enables profiling for the duration of a with block.
+
+    Parameters
+    __________
+    memory : bool
+        Also record peak allocations per stage with tracemalloc. This slows
+        down the computation considerably.
+
+    Yields
+    ______
+    prof : Profile
+        Collected events
+    '''
+    global _active
+    previous = _active
+    prof = Profile(memory=memory)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _active = prof
+    try:
+        yield prof
+    finally:
+        _active = previous
+        if started:
+            tracemalloc.stop()
+
+
+def _profile_from_env():
+    '''
+    Enables process-wide profiling if CNRGUI_PROFILE is set
+    '''
+    global _active
+    target = os.environ.get('CNRGUI_PROFILE', '')
+    if target in ('', '0'):
+        return
+    _active = Profile()
+
+    def report(prof=_active):
+        if target.endswith('.json'):
+            prof.dump_chrome_trace(target)
+        else:
+            sys.stderr.write(prof.summary() + '\n')
+    atexit.register(report)
+
+
+_profile_from_env()
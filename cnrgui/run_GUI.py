@@ -27,10 +27,24 @@ c_p_max = 0.005
 # Chose maximum intensity value, in number of photons
 max_intensity_val = 1e5
 
+# Set to True to display the time taken to redraw the curve
+show_frame_time = False
+
+# Set to True to draw a coarse curve before the full curve on each change
+progressive = False
+
+# Session snapshot file. The GUI reopens with the sliders, selections and
+# curve saved there when it was last closed. Set to None to always start
+# from defaults
+session = 'cnrgui_session.npz'
+
 # This creates and launches a GUI displaying CNR as a function of energy
 # for parameter ranges chosen above
 GUI(thickness_values=np.array([d_min, d_max]),
     bg_density_values=np.array([bg_p_min, bg_p_max]),
     contrast_density_values=np.array([c_p_min, c_p_max]),
     max_intensity_value=max_intensity_val,
-    thickness_units=units)
+    thickness_units=units,
+    show_frame_time=show_frame_time,
+    progressive=progressive,
+    session=session)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+'''
+Local HTTP service returning CNR curves for the GUI's parameters, for use
+without a desktop window (e.g. from a web-based experiment planner).
+
+    python -m cnrgui.server --port 8050
+
+GET /cnr accepts the same parameters as the GUI sliders:
+
+    contrast            'H2O', 'Os', 'U' or 'Pb' (default 'Os')
+    bg_thickness        background thickness (default 1.5)
+    bg_density          background density, g/cc (default 1)
+    contrast_thickness  contrast thickness (default 0.5)
+    contrast_density    contrast density, g/cc (default 0.0025)
+    I0                  entrance intensity, photons (default 1)
+    bw                  bandwidth, 1e-2 or 1e-4 (default 1e-2)
+    E_min, E_max        energy range, keV (default 0, 40)
+    units               thickness units, 'mm' or 'nm' (default 'mm')
+    format              'json' (default) or 'png'
+
+JSON responses contain the energies, CNR values and optimal energy. PNG
+responses are rendered with the Agg backend.
+'''
+
+import io
+import json
+import math
+import argparse
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from cnrgui.material import MaterialSet
+from cnrgui.util import cnr, window_indices
+
+MATERIALS = ('H2O', 'Os', 'U', 'Pb')
+
+# Bandwidth options of the GUI
+BANDWIDTHS = (1e-2, 1e-4)
+
+# Parameter name: (type, default)
+PARAMETERS = {'contrast': (str, 'Os'),
+              'bg_thickness': (float, 1.5),
+              'bg_density': (float, 1.0),
+              'contrast_thickness': (float, 0.5),
+              'contrast_density': (float, 0.0025),
+              'I0': (float, 1.0),
+              'bw': (float, 1e-2),
+              'E_min': (float, 0.0),
+              'E_max': (float, 40.0),
+              'units': (str, 'mm'),
+              'format': (str, 'json')}
+
+
+@lru_cache(maxsize=None)
+def get_materials(contrast):
+    '''
+    Returns the H2O background and contrast attenuation on a shared grid.
+    Cached, and immutable so that it is shared between worker threads.
+    '''
+    return MaterialSet.from_names(['H2O', contrast])
+
+
+def parse_params(query):
+    '''
+    Validates query parameters, returns a hashable tuple of
+    (name, value) pairs. Raises ValueError for invalid values.
+    '''
+    params = {}
+    for name, (kind, default) in PARAMETERS.items():
+        values = query.get(name)
+        params[name] = default if not values else kind(values[0])
+
+    unknown = set(query) - set(PARAMETERS)
+    if unknown:
+        raise ValueError('Unknown parameters: {}'.format(sorted(unknown)))
+    if params['contrast'] not in MATERIALS:
+        raise ValueError('contrast must be one of {}'.format(MATERIALS))
+    if params['units'] not in ('mm', 'nm'):
+        raise ValueError("units must be 'mm' or 'nm'")
+    if params['format'] not in ('json', 'png'):
+        raise ValueError("format must be 'json' or 'png'")
+    for name, (kind, default) in PARAMETERS.items():
+        if kind is float and not math.isfinite(params[name]):
+            raise ValueError('{} must be finite'.format(name))
+    if params['bw'] not in BANDWIDTHS:
+        raise ValueError('bw must be one of {}'.format(BANDWIDTHS))
+    if params['E_min'] >= params['E_max']:
+        raise ValueError('E_min must be less than E_max')
+    for name in ('bg_thickness', 'bg_density', 'contrast_thickness',
+                 'contrast_density', 'I0'):
+        if not params[name] > 0:
+            raise ValueError('{} must be positive'.format(name))
+    return tuple(sorted(params.items()))
+
+
+def compute(params):
+    '''
+    Calculates the CNR curve for a parameter tuple from parse_params.
+
+    Returns
+    _______
+    body : bytes
+        JSON or PNG response body
+    content_type : str
+    '''
+    p = dict(params)
+    mset = get_materials(p['contrast'])
+    bg = mset.spec('H2O', thickness=p['bg_thickness'], density=p['bg_density'])
+    contrast = mset.spec(p['contrast'], thickness=p['contrast_thickness'],
+                         density=p['contrast_density'])
+    E_window = (p['E_min'], p['E_max'])
+    conv = 1e-7 if p['units'] == 'nm' else 0.1
+
+    CNR = cnr(bg, contrast, I0=p['I0'], bw=p['bw'], conv=conv,
+              E_window=E_window)
+    E = mset.E[window_indices(mset.E, E_window)]
+
+    # The curve extends to the nearest energy outside each edge of the window
+    inside = (E >= E_window[0]) & (E <= E_window[1])
+    E_opt = float(E[inside][CNR[inside].argmax()]) if inside.any() else None
+
+    if p['format'] == 'json':
+        body = json.dumps({'E': E.tolist(),
+                           'cnr': CNR.tolist(),
+                           'E_opt': E_opt,
+                           'params': p}).encode()
+        return body, 'application/json'
+
+    fig = Figure(figsize=(8, 5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.plot(E, CNR, 'k')
+    ax.set_xlim(E_window)
+    ax.set_ylim(bottom=0)
+    ax.set_xlabel('E [keV]')
+    ax.set_ylabel('CNR')
+    ax.set_title(r'CNR = $\mu_c$ / $\sqrt{var\{\mu_c\} + var\{\mu_c + \mu_{bg}\}}$')
+    ax.grid(True)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue(), 'image/png'
+
+
+class CNRServer(ThreadingHTTPServer):
+    '''
+    HTTP server computing CNR curves on a pool of worker threads.
+
+    Identical requests that arrive while one is being computed share its
+    result instead of being computed again.
+
+    Parameters
+    __________
+    address : tuple
+        (host, port) to listen on
+    workers : int
+        Number of worker threads computing curves
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 8050), workers=4):
+        super().__init__(address, CNRRequestHandler)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+        # Warms the material cache before the first request
+        for name in MATERIALS:
+            get_materials(name)
+
+    def submit(self, params):
+        '''
+        Returns a future for the response to params, shared with any
+        identical request in flight.
+        '''
+        with self.lock:
+            future = self.inflight.get(params)
+            if future is not None:
+                return future
+            future = self.pool.submit(compute, params)
+            self.inflight[params] = future
+
+        # Registered without the lock held: if the future is already done,
+        # the callback runs immediately in this thread and takes the lock
+        future.add_done_callback(lambda f: self._done(params, f))
+        return future
+
+    def _done(self, params, future):
+        with self.lock:
+            # A later identical request may have replaced the entry
+            if self.inflight.get(params) is future:
+                del self.inflight[params]
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+class CNRRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Handles GET /cnr requests for CNRServer
+    '''
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/cnr':
+            return self._send(404, json.dumps({'error': 'Not found'}).encode(),
+                              'application/json')
+        try:
+            params = parse_params(parse_qs(url.query))
+        except ValueError as e:
+            return self._send(400, json.dumps({'error': str(e)}).encode(),
+                              'application/json')
+        try:
+            body, content_type = self.server.submit(params).result()
+        except Exception as e:
+            return self._send(500, json.dumps({'error': str(e)}).encode(),
+                              'application/json')
+        self._send(200, body, content_type)
+
+    def _send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=8050, workers=4):
+    '''
+    Runs a CNRServer until interrupted.
+    '''
+    server = CNRServer((host, port), workers=workers)
+    print('Serving CNR curves on http://{}:{}/cnr'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CNR render server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
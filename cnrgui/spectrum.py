@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+import hashlib
+import numpy as np
+from scipy import sparse
+
+
+class Spectrum(object):
+    '''
+    Incident x-ray spectrum, used in place of the Gaussian bandwidth model of
+    cnrgui.util.get_N.
+
+    For each set energy the spectrum is folded into a sparse response matrix
+    R, so that the number of photons at every set energy is the single
+    sparse product
+
+        N = I0 * R @ exp(-A)
+
+    (evaluated in log space by log_average)
+
+    where A is the attenuation projection sampled on the materials' energy
+    grid. R is cached per (set energies, grid), so after the first call an
+    evaluation costs less than the Gaussian model.
+
+    Use one of the constructors:
+
+        Spectrum.relative(dE_E, intensity, harmonics=None)
+            A line shape that scales with the set energy, e.g. a measured
+            monochromator spectrum, plus optional harmonics
+        Spectrum.tabulated(E, intensity)
+            A fixed spectrum independent of the set energy, e.g. pink beam
+
+    Parameters
+    __________
+    E : ndarray
+        Energies (keV) for a fixed spectrum, or fractional offsets
+        (E' - E) / E from the set energy for a relative spectrum
+    intensity : ndarray
+        Relative intensity at each value of E. Need not be normalized
+    relative : bool
+        Whether E contains fractional offsets from the set energy
+    harmonics : dict
+        {order: relative intensity} of harmonics of a relative spectrum. The
+        fundamental has order 1 and intensity 1 unless given
+    '''
+
+    def __init__(self, E, intensity, relative=False, harmonics=None):
+        self.E = np.asarray(E, dtype=float)
+        self.intensity = np.asarray(intensity, dtype=float)
+        if self.E.shape != self.intensity.shape or self.E.ndim != 1:
+            raise ValueError('E and intensity must be 1D arrays of equal size')
+        self.relative = relative
+        self.harmonics = {1: 1.0}
+        if harmonics is not None:
+            if not relative:
+                raise ValueError('harmonics require a relative spectrum')
+            self.harmonics.update(harmonics)
+        self._response = {}
+
+    @classmethod
+    def relative(cls, dE_E, intensity, harmonics=None):
+        '''
+        Spectrum whose shape follows the set energy.
+
+        Parameters
+        __________
+        dE_E : ndarray
+            Fractional offsets (E' - E) / E from the set energy E
+        intensity : ndarray
+            Relative intensity at each offset
+        harmonics : dict
+            {order: relative intensity}, e.g. {3: 0.01} for a 1% third
+            harmonic
+        '''
+        return cls(dE_E, intensity, relative=True, harmonics=harmonics)
+
+    @classmethod
+    def tabulated(cls, E, intensity):
+        '''
+        Fixed spectrum, the same for every set energy.
+
+        Parameters
+        __________
+        E : ndarray
+            Energies in keV
+        intensity : ndarray
+            Relative intensity at each energy
+        '''
+        return cls(E, intensity)
+
+    def key(self):
+        '''
+        Returns a hex digest identifying the spectrum, e.g. for
+        cnrgui.cache.CNRCache
+        '''
+        h = hashlib.sha256()
+        h.update(self.E.tobytes())
+        h.update(self.intensity.tobytes())
+        h.update(repr((self.relative, sorted(self.harmonics.items()))).encode())
+        return h.hexdigest()
+
+    def samples(self, E_set):
+        '''
+        Returns the energies and normalized weights of the spectrum at each
+        set energy.
+
+        Parameters
+        __________
+        E_set : (M,) ndarray
+            Set (nominal) energies in keV
+
+        Returns
+        _______
+        Ep : (M, K) ndarray
+            Row i contains the energies in the spectrum for E_set[i]
+        W : (M, K) ndarray
+            Weights for each energy in Ep. Rows sum to 1
+        '''
+        E_set = np.asarray(E_set, dtype=float)
+        if self.relative:
+            Ep = np.concatenate([order * E_set[:, None] * (1 + self.E)
+                                 for order in self.harmonics], axis=-1)
+            W = np.concatenate([weight * self.intensity
+                                for weight in self.harmonics.values()])
+        else:
+            Ep = np.broadcast_to(self.E, (E_set.size, self.E.size))
+            W = self.intensity
+        W = np.broadcast_to(W / W.sum(), Ep.shape)
+        return Ep, W
+
+    def response_matrix(self, E_set, E_grid):
+        '''
+        Returns the sparse matrix mapping values sampled along E_grid to their
+        spectrum-weighted averages at each set energy.
+
+        Each spectrum energy contributes to its two neighboring grid points
+        with linear interpolation weights. As in cnrgui.util.get_N, the
+        fundamental of a relative spectrum is padded with the minimum and
+        maximum of E_grid. Raises ValueError if any other energy (harmonics,
+        or a tabulated spectrum) is outside of E_grid, since there is no
+        attenuation data for it.
+
+        Parameters
+        __________
+        E_set : (M,) ndarray
+            Set energies in keV
+        E_grid : (G,) ndarray
+            Increasing energies, in keV, at which the averaged quantity is
+            sampled
+
+        Returns
+        _______
+        R : (M, G) scipy.sparse.csr_matrix
+            Response matrix. Rows sum to 1
+        '''
+        E_set = np.asarray(E_set, dtype=float)
+        E_grid = np.asarray(E_grid, dtype=float)
+        cache_key = (E_set.tobytes(), E_grid.tobytes())
+        R = self._response.get(cache_key)
+        if R is not None:
+            return R
+
+        Ep, W = self.samples(E_set)
+        outside = (Ep < E_grid[0]) | (Ep > E_grid[-1])
+        if self.relative:
+            # The fundamental comes first in samples
+            outside[:, :self.E.size] = False
+        if outside.any():
+            raise ValueError(
+                'spectrum energies from {:.4g} to {:.4g} keV are outside of '
+                'E_grid ({:.4g} - {:.4g} keV)'.format(
+                    Ep[outside].min(), Ep[outside].max(), E_grid[0],
+                    E_grid[-1]))
+        Ep = np.clip(Ep, E_grid[0], E_grid[-1])
+
+        # Lower neighbor on the grid and the linear interpolation weight of
+        # the upper neighbor
+        j = np.clip(np.searchsorted(E_grid, Ep, side='right') - 1,
+                    0, E_grid.size - 2)
+        frac = (Ep - E_grid[j]) / (E_grid[j + 1] - E_grid[j])
+
+        rows = np.broadcast_to(np.arange(E_set.size)[:, None], Ep.shape)
+        R = sparse.coo_matrix(
+            (np.concatenate([(W * (1 - frac)).ravel(), (W * frac).ravel()]),
+             (np.concatenate([rows.ravel(), rows.ravel()]),
+              np.concatenate([j.ravel(), j.ravel() + 1]))),
+            shape=(E_set.size, E_grid.size)).tocsr()
+        R.eliminate_zeros()
+
+        # Keeps only the most recent grids
+        if len(self._response) >= 8:
+            self._response.clear()
+        self._response[cache_key] = R
+        return R
+
+    def log_average(self, E_set, E_grid, a):
+        '''
+        Returns log(R @ exp(a)) for the response matrix R, computed without
+        overflow or underflow by shifting a by its maximum in each row.
+
+        Parameters
+        __________
+        E_set : (M,) ndarray
+            Set energies in keV
+        E_grid : (G,) ndarray
+            Increasing energies, in keV, at which a is sampled
+        a : (G,) ndarray
+            Log of the quantity to average, e.g. -A for transmission
+
+        Returns
+        _______
+        log_avg : (M,) ndarray
+        '''
+        R = self.response_matrix(E_set, E_grid)
+        vals = a[R.indices]
+
+        # Every row has at least one entry, since the weights sum to 1
+        shift = np.maximum.reduceat(vals, R.indptr[:-1])
+        rows = np.repeat(np.arange(R.shape[0]), np.diff(R.indptr))
+        total = np.bincount(rows, weights=R.data * np.exp(vals - shift[rows]),
+                            minlength=R.shape[0])
+        return shift + np.log(total)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+'''
+Chunked on-disk storage for CNR curves and sweeps.
+
+A store is a directory containing
+
+    manifest.json           energy axis file and coordinate names
+    energy-<writer>.npy     shared energy axis
+    <shard>.npy / .npz      (rows, E) block of curves
+    <shard>.json            row count, write time and coordinates of each row
+                            in the shard
+
+Every append writes a new shard, and each writer names its shards with its
+own id, so several processes can append to one store without locks. A shard's
+.json sidecar is written (atomically) after its data, so readers only ever
+see complete shards. The manifest is created exclusively, so the first writer
+defines the store and later writers are checked against it.
+
+Rows are numbered in the order their shards were written. Shards that
+appear after a store was opened are numbered after the existing rows, so
+row indices never change on refresh.
+
+Uncompressed .npy shards are memory-mapped when read, so slices of a large
+sweep can be plotted without loading it. Compressed .npz shards use less disk
+space but are decompressed in full when read.
+
+    writer = CurveWriter('sweep', E, coords=('bw', 'bg_thickness'))
+    for bw in (1e-2, 1e-4):
+        writer.append(curves, bw=bw, bg_thickness=thicknesses)
+
+    store = CurveStore('sweep')
+    rows = store.select(bw=1e-2)
+    plt.plot(store.E, store[rows[0]])
+'''
+
+import os
+import json
+import glob
+import time
+import uuid
+import socket
+import numpy as np
+
+
+class CurveWriter(object):
+    '''
+    Appends curves to a store, creating it if needed.
+
+    Parameters
+    __________
+    path : str
+        Store directory
+    E : ndarray
+        Energy axis shared by all curves, in keV. Must match the store's if
+        it already exists
+    coords : sequence of str
+        Names of the parameter coordinates attached to each curve
+    compress : bool
+        Writes compressed .npz shards instead of memory-mappable .npy shards
+    dtype : numpy dtype
+        Storage type of the curves
+    writer_id : str
+        Prefix for this writer's shards. Defaults to a unique id from the
+        host name, process id and a random suffix
+    '''
+
+    def __init__(self, path, E, coords=(), compress=False, dtype=np.float64,
+                 writer_id=None):
+        self.path = path
+        self.E = np.asarray(E, dtype=float)
+        self.coords = tuple(coords)
+        self.compress = compress
+        self.dtype = np.dtype(dtype)
+        if writer_id is None:
+            writer_id = '{}-{}-{}'.format(socket.gethostname(), os.getpid(),
+                                          uuid.uuid4().hex[:8])
+        self.writer_id = writer_id
+        self.n_shards = 0
+
+        os.makedirs(path, exist_ok=True)
+        manifest = os.path.join(path, 'manifest.json')
+        if not os.path.exists(manifest):
+            # Energy axis first, then the manifest pointing to it. Linking
+            # the manifest fails if another writer created the store first.
+            energy = 'energy-{}.npy'.format(writer_id)
+            _atomic_save(os.path.join(path, energy), self.E)
+            tmp = '{}.{}.tmp'.format(manifest, uuid.uuid4().hex[:8])
+            with open(tmp, 'w') as f:
+                f.write(json.dumps({'energy': energy,
+                                    'coords': list(self.coords)}))
+            try:
+                os.link(tmp, manifest)
+            except FileExistsError:
+                os.remove(os.path.join(path, energy))
+            finally:
+                os.remove(tmp)
+
+        with open(manifest) as f:
+            info = json.load(f)
+        E_store = np.load(os.path.join(path, info['energy']))
+        if list(info['coords']) != list(self.coords):
+            raise ValueError('Store has coordinates {}'.format(info['coords']))
+        if E_store.shape != self.E.shape or not np.allclose(E_store, self.E):
+            raise ValueError('Store has a different energy axis')
+
+    def append(self, curves, **coords):
+        '''
+        Writes a block of curves as a new shard.
+
+        Parameters
+        __________
+        curves : (E,) or (rows, E) ndarray
+            CNR curves along the store's energy axis
+        coords : scalar or (rows,) array
+            Value of each coordinate for each row. Scalars apply to all rows
+        '''
+        curves = np.atleast_2d(np.asarray(curves, dtype=self.dtype))
+        if curves.shape[1] != self.E.size:
+            raise ValueError('curves must have {} energies'.format(self.E.size))
+        if set(coords) != set(self.coords):
+            raise ValueError('coords must be {}'.format(self.coords))
+        rows = curves.shape[0]
+        values = {}
+        for name, value in coords.items():
+            value = np.broadcast_to(np.asarray(value), (rows,))
+            values[name] = value.tolist()
+
+        name = '{}-{:06d}'.format(self.writer_id, self.n_shards)
+        fn = name + ('.npz' if self.compress else '.npy')
+        _atomic_save(os.path.join(self.path, fn), curves, self.compress)
+        _atomic_write(os.path.join(self.path, name + '.json'),
+                      json.dumps({'file': fn, 'rows': rows,
+                                  'time': time.time_ns(), 'coords': values}))
+        self.n_shards += 1
+
+
+class CurveStore(object):
+    '''
+    Reads curves from a store written by CurveWriter.
+
+    Indexing returns curves without loading the rest of the store:
+    store[i], store[10:20], store[rows, E_slice].
+
+    Attributes
+    __________
+    E : ndarray
+        Energy axis
+    coords : dict of ndarray
+        Coordinate values for every row of the store
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            info = json.load(f)
+        self.E = np.load(os.path.join(path, info['energy']))
+        self.coord_names = tuple(info['coords'])
+        self._open = {}
+        self._shards = []
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Picks up shards appended since the store was opened. New shards are
+        numbered after the existing rows, in order of their write time.
+        '''
+        known = {s['file'] for s in self._shards}
+        new = []
+        for fn in glob.glob(os.path.join(self.path, '*.json')):
+            if os.path.basename(fn) == 'manifest.json':
+                continue
+            with open(fn) as f:
+                shard = json.load(f)
+            if shard['file'] not in known:
+                new.append(shard)
+        new.sort(key=lambda s: (s['time'], s['file']))
+        shards = self._shards + new
+        self._shards = shards
+        self._offsets = np.cumsum([0] + [s['rows'] for s in shards])
+        self.coords = {name: np.array([v for s in shards
+                                       for v in s['coords'][name]])
+                       for name in self.coord_names}
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def select(self, **conditions):
+        '''
+        Returns the row indices whose coordinates equal the given values.
+        '''
+        mask = np.ones(len(self), dtype=bool)
+        for name, value in conditions.items():
+            mask &= self.coords[name] == value
+        return np.flatnonzero(mask)
+
+    def __getitem__(self, index):
+        rows, cols = index if isinstance(index, tuple) else (index, slice(None))
+        if isinstance(rows, (int, np.integer)):
+            return self[[rows], cols][0]
+        if isinstance(cols, (int, np.integer)):
+            # A single energy, kept 2D while filling the output
+            cols = np.arange(self.E.size)[cols]
+            return self[rows, cols:cols + 1][:, 0]
+
+        rows = np.arange(len(self))[rows]
+        out = np.empty((rows.size, self.E[cols].size))
+        shard = np.searchsorted(self._offsets, rows, side='right') - 1
+        for s in np.unique(shard):
+            which = shard == s
+            data = self._load(s)
+            out[which] = data[rows[which] - self._offsets[s]][:, cols]
+        return out
+
+    def _load(self, s):
+        '''
+        Memory-maps (.npy) or decompresses (.npz) shard s
+        '''
+        fn = self._shards[s]['file']
+        data = self._open.get(fn)
+        if data is None:
+            full = os.path.join(self.path, fn)
+            if fn.endswith('.npz'):
+                with np.load(full) as f:
+                    data = f['curves']
+                # Only the most recent compressed shard is kept in memory
+                self._open = {k: v for k, v in self._open.items()
+                              if not k.endswith('.npz')}
+            else:
+                data = np.load(full, mmap_mode='r')
+            self._open[fn] = data
+        return data
+
+
+def _atomic_save(fn, a, compress=False):
+    '''
+    Saves an array to fn via a temporary file in the same directory
+    '''
+    tmp = '{}.{}.tmp'.format(fn, uuid.uuid4().hex[:8])
+    with open(tmp, 'wb') as f:
+        if compress:
+            np.savez_compressed(f, curves=a)
+        else:
+            np.save(f, a)
+    os.replace(tmp, fn)
+
+
+def _atomic_write(fn, text):
+    '''
+    Writes text to fn via a temporary file in the same directory
+    '''
+    tmp = '{}.{}.tmp'.format(fn, uuid.uuid4().hex[:8])
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, fn)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import numpy as np
+from cnrgui.optimize import batch_cnr
+
+# Inputs that are perturbed by a single factor per sample, in the order of
+# the columns of UncertaintyResult.factors
+INPUTS = ('bg_u_p', 'contrast_u_p', 'bg_thickness', 'bg_density',
+          'contrast_thickness', 'contrast_density')
+
+
+class UncertaintyResult(object):
+    '''
+    Confidence bands on CNR(E) and on the optimal energy, as returned by
+    cnrgui.uncertainty.propagate_uncertainty.
+
+    Attributes
+    __________
+    E : (E,) ndarray
+        Energies in keV
+    cnr : (E,) ndarray
+        Median CNR at each energy
+    lower, upper : (E,) ndarray
+        Lower and upper bounds of the CNR confidence band at each energy
+    E_opt : (N,) ndarray
+        Optimal energy of each sample
+    E_opt_interval : tuple
+        (lower, median, upper) optimal energy
+    cnr_opt : (N,) ndarray
+        CNR at the optimal energy of each sample
+    level : float
+        Confidence level of the bands
+    factors : (N, 6) ndarray
+        Standard normal draws for each input in cnrgui.uncertainty.INPUTS.
+        Columns of uncorrelated attenuation tables are NaN
+    sensitivity : dict
+        {input: d log(cnr_opt) / d log(input)}, estimated by least squares
+        over the samples. NaN for inputs that were not perturbed
+    '''
+
+    def __init__(self, E, cnr, lower, upper, E_opt, E_opt_interval, cnr_opt,
+                 level, factors, sensitivity):
+        self.E = E
+        self.cnr = cnr
+        self.lower = lower
+        self.upper = upper
+        self.E_opt = E_opt
+        self.E_opt_interval = E_opt_interval
+        self.cnr_opt = cnr_opt
+        self.level = level
+        self.factors = factors
+        self.sensitivity = sensitivity
+
+    def __repr__(self):
+        return 'UncertaintyResult({} samples, E_opt {:.2f} [{:.2f}, {:.2f}] keV)'.format(
+            self.E_opt.size, self.E_opt_interval[1], self.E_opt_interval[0],
+            self.E_opt_interval[2])
+
+
+def propagate_uncertainty(bg, contrast, bg_u_p_rel=0, contrast_u_p_rel=0,
+                          bg_thickness_rel=0, bg_density_rel=0,
+                          contrast_thickness_rel=0, contrast_density_rel=0,
+                          correlated=True, n_samples=1000, level=0.95, I0=1,
+                          bw=1e-2, E_range=None, conv=0.1, truncate=4, n=50,
+                          scheme='linspace', chunk_size=256, seed=None):
+    '''
+    Propagates uncertainties in the attenuation tables, thicknesses and
+    densities to CNR(E) and the optimal energy by Monte Carlo sampling.
+
+    Each input x is perturbed log-normally, x * exp(rel * z) with z standard
+    normal, so that rel is its relative standard deviation and perturbed
+    values stay positive. All samples are evaluated together by
+    cnrgui.optimize.batch_cnr, chunk_size samples at a time.
+
+    Parameters
+    __________
+    bg : Material
+        Background material, with E and u_p set by
+        cnrgui.util.match_energies, and thickness and density set
+    contrast : Material
+        Contrast material, with E and u_p matched to bg
+    bg_u_p_rel, contrast_u_p_rel : float or (E,) ndarray
+        Relative standard deviation of the mass attenuation of each material
+        at each energy (e.g. 0.01 - 0.05 for NIST tables)
+    bg_thickness_rel, bg_density_rel : float
+        Relative standard deviation of the background thickness and density
+    contrast_thickness_rel, contrast_density_rel : float
+        Relative standard deviation of the contrast thickness and density
+    correlated : bool
+        If True, each attenuation table is scaled by one draw per sample, so
+        that its errors move together across energy. If False, each
+        tabulated energy is perturbed independently
+    n_samples : int
+        Number of Monte Carlo samples
+    level : float
+        Confidence level of the bands, e.g. 0.95 for 2.5 - 97.5 percentiles
+    I0 : int
+        Entrance intensity (number of photons)
+    bw : float
+        Fractional FWHM for intensity spectrum (BW = dE / E)
+    E_range : tuple
+        (E_min, E_max) in keV. Restricts the search for the optimum to this
+        energy window
+    conv : float
+        Conversion factor from material thickness units to cm
+    truncate : int or float
+        Number of standard deviations to include for BW averaging
+    n : int
+        Number of sampling points to use when calculating the Gaussian weights
+        for BW averaging
+    scheme : str
+        Quadrature used for BW averaging, 'linspace' or 'hermite'
+    chunk_size : int
+        Number of samples evaluated together. Peak memory use is roughly
+        3 * chunk_size * E * n * 8 bytes, plus n_samples * E * 8 bytes for
+        the CNR samples
+    seed : int
+        Seed for numpy.random.default_rng
+
+    Returns
+    _______
+    result : UncertaintyResult
+        CNR bands, optimal energy samples and sensitivities
+    '''
+
+    rng = np.random.default_rng(seed)
+    E_vals = bg.E
+    M = E_vals.size
+
+    # Energy window for the optimum
+    mask = np.ones(M, dtype=bool)
+    if E_range is not None:
+        mask = (E_vals >= E_range[0]) & (E_vals <= E_range[1])
+    E_win = E_vals[mask]
+
+    rel = [np.broadcast_to(np.asarray(r, dtype=float), (M,))
+           for r in (bg_u_p_rel, contrast_u_p_rel)]
+    rel += [float(r) for r in (bg_thickness_rel, bg_density_rel,
+                               contrast_thickness_rel, contrast_density_rel)]
+    nominal = (bg.thickness, bg.density, contrast.thickness, contrast.density)
+
+    factors = np.full((n_samples, len(INPUTS)), np.nan)
+    log_CNR = np.empty((n_samples, M))
+    for start in range(0, n_samples, chunk_size):
+        s = slice(start, min(start + chunk_size, n_samples))
+        S = s.stop - s.start
+
+        # Perturbed attenuation tables: (S, E)
+        u_p = []
+        for k, u_p0 in enumerate((bg.u_p, contrast.u_p)):
+            if correlated:
+                z = rng.standard_normal((S, 1))
+                factors[s, k] = z[:, 0]
+            else:
+                z = rng.standard_normal((S, M))
+            u_p.append(u_p0 * np.exp(rel[k] * z))
+
+        # Perturbed thicknesses and densities: (S,)
+        z = rng.standard_normal((S, 4))
+        factors[s, 2:] = z
+        params = [x * np.exp(r * z[:, k])
+                  for k, (x, r) in enumerate(zip(nominal, rel[2:]))]
+
+        log_CNR[s] = batch_cnr(E_vals, u_p[0], u_p[1], *params, I0=I0, bw=bw,
+                               conv=conv, truncate=truncate, n=n,
+                               scheme=scheme, log=True, chunk_size=chunk_size)
+
+    # Optimal energy of each sample, found in log space
+    j = log_CNR[:, mask].argmax(axis=-1)
+    E_opt = E_win[j]
+    log_opt = log_CNR[:, mask][np.arange(n_samples), j]
+
+    q = 100 * np.array([(1 - level) / 2, 0.5, (1 + level) / 2])
+    lower, median, upper = np.exp(np.percentile(log_CNR, q, axis=0))
+    E_opt_interval = tuple(np.percentile(E_opt, q))
+
+    # Elasticity of the peak CNR with respect to each perturbed input:
+    # log(input) = log(nominal) + rel * z
+    varied = np.array([np.any(r != 0) and not np.isnan(factors[:, k]).any()
+                       for k, r in enumerate(rel)])
+    sensitivity = dict.fromkeys(INPUTS, np.nan)
+    if varied.any():
+        log_inputs = factors[:, varied] * np.array(
+            [np.mean(r) for k, r in enumerate(rel) if varied[k]])
+        X = np.column_stack([np.ones(n_samples), log_inputs])
+        coef = np.linalg.lstsq(X, log_opt, rcond=None)[0][1:]
+        for name, c in zip(np.array(INPUTS)[varied], coef):
+            sensitivity[name] = float(c)
+
+    return UncertaintyResult(E=E_vals, cnr=median, lower=lower, upper=upper,
+                             E_opt=E_opt, E_opt_interval=E_opt_interval,
+                             cnr_opt=np.exp(log_opt), level=level,
+                             factors=factors, sensitivity=sensitivity)
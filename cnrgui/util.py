@@ -1,7 +1,16 @@
 import numpy as np
+from functools import lru_cache
 from scipy.interpolate import InterpolatedUnivariateSpline
+from scipy.special import logsumexp
+from cnrgui.profiling import timed
 
+# Version of the values returned by cnr, part of its cache keys. Bump it
+# whenever cnr returns different values for the same inputs, so that curves
+# cached by earlier versions are not reused
+CNR_MODEL_VERSION = 2
 
+
+@timed('match_energies')
 def match_energies(mat1, mat2):
     '''
     Match sampled energy values between two materials along the most densely
@@ -28,6 +37,7 @@ def match_energies(mat1, mat2):
     small.u_p = log_interp(small.E_raw, small.u_p_raw, big.E)
 
 
+@timed('log_interp')
 def log_interp(x, y, x_new):
     '''
     Calculates a log-log linear interpolation and extrapolation
@@ -59,7 +69,11 @@ def log_interp(x, y, x_new):
     return new_y
 
 
-def cnr(bg, contrast, I0=1, bw=1e-2, conv=0.1, truncate=4, n=50):
+@timed('cnr')
+def cnr(bg, contrast, I0=1, bw=1e-2, conv=0.1, truncate=4, n=50,
+        scheme='linspace', spectrum=None, E_window=None, step=1,
+        voxel_size=None, n_projections=1, c_filter=1 / 12, log=False,
+        cache=None):
     '''
     Calculates CNR for two-material model.
 
@@ -80,13 +94,48 @@ def cnr(bg, contrast, I0=1, bw=1e-2, conv=0.1, truncate=4, n=50):
     n : int
         Number of sampling points to use when calculating the Gaussian weights
         for BW averaging
+    scheme : str
+        Quadrature used for BW averaging, 'linspace' or 'hermite'. See
+        cnrgui.util.get_bw_samples
+    spectrum : cnrgui.spectrum.Spectrum
+        Incident spectrum. If given, it replaces the Gaussian BW model and
+        bw, truncate, n and scheme are ignored. The contrast attenuation of a
+        tabulated (not relative) spectrum is also averaged over the spectrum
+    E_window : tuple
+        (E_min, E_max) in keV. If given, CNR is only calculated at energies
+        in this window and the nearest energy on each side of it (see
+        cnrgui.util.window_indices). Tabulated values outside of it are
+        still used for BW averaging
+    step : int
+        Calculates CNR at every step-th energy only, e.g. for a quick coarse
+        curve
+    voxel_size : float or ndarray
+        Reconstructed voxel (detector pixel) size in material thickness
+        units. If given, the variance includes the c_filter * pi**2 / m
+        factor of the Spanne noise model (see
+        cnrgui.util.log_resolution_factor), and I0 is the number of photons
+        per detector pixel per projection
+    n_projections : int or ndarray
+        Number of projections m over 180 degrees. Only used with voxel_size
+    c_filter : float
+        Variance factor of the reconstruction filter, in units of
+        1 / voxel_size**2. 1 / 12 for the Ram-Lak filter
+    log : bool
+        Returns log(CNR), which stays finite for very strong attenuation
+    cache : cnrgui.cache.CNRCache
+        Optional on-disk cache. If given, identical computations are read
+        back from disk instead of being recomputed
 
 
     Returns
     _______
     CNR : ndarray
         Values of CNR at the energy values given by the E attribute of both
-        bg and contrast
+        bg and contrast, restricted to
+        bg.E[cnrgui.util.window_indices(bg.E, E_window, step)]. If
+        voxel_size and n_projections are arrays, they are broadcast together
+        and CNR has shape (*broadcast shape, E), e.g. for a grid of
+        magnifications and numbers of angles in one call
 
 
     Notes
@@ -102,7 +151,26 @@ def cnr(bg, contrast, I0=1, bw=1e-2, conv=0.1, truncate=4, n=50):
 
     '''
 
+    if cache is not None:
+        key = cache.key([bg.E, bg.u_p, contrast.u_p],
+                        model_version=CNR_MODEL_VERSION,
+                        bg_thickness=bg.thickness, bg_density=bg.density,
+                        contrast_thickness=contrast.thickness,
+                        contrast_density=contrast.density,
+                        I0=I0, bw=bw, conv=conv, truncate=truncate, n=n,
+                        scheme=scheme,
+                        spectrum=None if spectrum is None else spectrum.key(),
+                        E_window=E_window, step=step,
+                        voxel_size=None if voxel_size is None else
+                        np.asarray(voxel_size).tolist(),
+                        n_projections=np.asarray(n_projections).tolist(),
+                        c_filter=c_filter, log=log)
+        CNR = cache.get(key)
+        if CNR is not None:
+            return CNR
+
     E_vals = bg.E
+    idx = window_indices(E_vals, E_window, step)
 
     # Mass attenuation to linear attenuation coefficient
     u_c = contrast.u_p * contrast.density
@@ -116,21 +184,39 @@ def cnr(bg, contrast, I0=1, bw=1e-2, conv=0.1, truncate=4, n=50):
     A1 = u_bg * d_bg
     A2 = u_bg * d_bg + u_c * d_c
 
-    # Number of photons
-    N1 = get_N(A1, E_vals, bw=bw, I0=I0, truncate=truncate, n=n)
-    N2 = get_N(A2, E_vals, bw=bw, I0=I0, truncate=truncate, n=n)
-
-    # Some N values will be 0. The call to np.where sets CNR=0 at
-    # those points, but will still throw a NumPy "divide by 0" warning,
-    # so I temporarily suspend that warnings.
-    with np.errstate(divide='ignore'):
-        CNR = np.where((N1 != 0) | (N2 != 0), u_c /
-                       np.sqrt((1 / N1) + (1 / N2)), 0)
+    # Log of the number of photons
+    logN1 = get_logN(A1, E_vals, bw=bw, I0=I0, truncate=truncate, n=n,
+                     scheme=scheme, spectrum=spectrum, E_out=E_vals[idx])
+    logN2 = get_logN(A2, E_vals, bw=bw, I0=I0, truncate=truncate, n=n,
+                     scheme=scheme, spectrum=spectrum, E_out=E_vals[idx])
+
+    # A tabulated spectrum does not depend on the set energy, so the contrast
+    # is weighted by the spectrum like N
+    if spectrum is not None and not spectrum.relative:
+        u_c_out = spectrum.response_matrix(E_vals[idx], E_vals) @ u_c
+    else:
+        u_c_out = u_c[idx]
+
+    # CNR = u_c / sqrt(1/N1 + 1/N2), with the variance summed in log space.
+    # Strong attenuation gives a very small CNR instead of dividing by 0.
+    with np.errstate(divide='ignore'):  # log(0) = -inf for zero density
+        log_CNR = np.log(u_c_out) - 0.5 * np.logaddexp(-logN1, -logN2)
+
+    # Resolution dependence, separable from the energy dependence
+    if voxel_size is not None:
+        log_CNR = log_CNR + log_resolution_factor(
+            voxel_size, n_projections, conv=conv, c_filter=c_filter)[..., None]
+    CNR = log_CNR if log else np.exp(log_CNR)
+
+    if cache is not None:
+        cache.put(key, CNR)
 
     return CNR
 
 
-def get_N(A, E_vals, bw=1e-2, I0=1, truncate=4, n=50):
+@timed('get_N')
+def get_N(A, E_vals, bw=1e-2, I0=1, truncate=4, n=50, scheme='linspace',
+          spectrum=None, E_out=None):
     '''
     Calculate N, the number of photons through the central point of a
     CNR phantom.
@@ -150,37 +236,212 @@ def get_N(A, E_vals, bw=1e-2, I0=1, truncate=4, n=50):
     n : int
         Number of sampling points to use when calculating the Gaussian weights
         for BW averaging
+    scheme : str
+        Quadrature used for BW averaging, 'linspace' or 'hermite'
+    spectrum : cnrgui.spectrum.Spectrum
+        Incident spectrum replacing the Gaussian BW model
+    E_out : ndarray
+        Energies at which to calculate N. Defaults to E_vals
 
     Returns
     _______
     N : ndarray
-        Energy-dependent number of photons through center of CNR phantom.
+        Energy-dependent number of photons through center of CNR phantom,
+        at each energy in E_out. Underflows to 0 for very strong
+        attenuation, use cnrgui.util.get_logN instead
 
     '''
 
-    # Calculates a n-length Gaussian kernel, with points
-    # ranging from minus to plus (truncate * standard deviation)
-    # (i.e., for sd=1, truncate=4: ranges from [-4,4]
-    G = np.exp(-0.5 * np.linspace(-truncate, truncate, n)**2)
-    G /= G.sum()
+    return np.exp(get_logN(A, E_vals, bw=bw, I0=I0, truncate=truncate, n=n,
+                           scheme=scheme, spectrum=spectrum, E_out=E_out))
+
+
+@timed('get_logN')
+def get_logN(A, E_vals, bw=1e-2, I0=1, truncate=4, n=50, scheme='linspace',
+             spectrum=None, E_out=None):
+    '''
+    Calculate log(N), the log of the number of photons through the central
+    point of a CNR phantom. The average over the spectrum is done with
+    log-sum-exp, so log(N) stays finite however strong the attenuation.
+
+    Parameters are the same as for cnrgui.util.get_N.
+
+    Returns
+    _______
+    logN : ndarray
+        Natural log of N at each energy in E_out
+    '''
+
+    E_out = E_vals if E_out is None else E_out
+    if E_out.size == 0:
+        return np.empty(0)
+
+    # Zero attenuation (e.g. zero thickness) is floored to keep its log finite
+    A = np.maximum(A, np.finfo(float).tiny)
+
+    if spectrum is not None:
+        # Spectrum averaging with a single (cached) sparse response matrix
+        return np.log(I0) + spectrum.log_average(E_out, E_vals, -A)
+
+    Ep, G = get_bw_samples(E_out, bw=bw, truncate=truncate, n=n,
+                           scheme=scheme, bounds=(E_vals.min(), E_vals.max()))
+
+    # Only the tabulated points spanning Ep are needed for interpolation
+    lo = max(np.searchsorted(E_vals, Ep.min(), side='right') - 1, 0)
+    hi = min(max(np.searchsorted(E_vals, Ep.max()) + 1, lo + 2), E_vals.size)
+    lo = min(lo, hi - 2)
+
+    # Interpolated values for A along Ep
+    A_int = log_interp(E_vals[lo:hi], A[lo:hi], Ep)
+
+    # log of the weighted sum of exp(-A) over Ep for each E in E_out
+    return np.log(I0) + logsumexp(-A_int, b=G, axis=-1)
+
+
+@timed('get_bw_samples')
+def get_bw_samples(E_vals, bw=1e-2, truncate=4, n=50, scheme='linspace',
+                   bounds=None):
+    '''
+    Calculates the energies and Gaussian weights used for BW averaging.
+
+    Parameters
+    __________
+    E_vals : ndarray
+        Sampled energy values
+    bw : float
+        Fractional FWHM for intensity spectrum (BW = dE / E)
+    truncate : int or float
+        Number of standard deviations to include for BW averaging. Only used
+        by the 'linspace' scheme
+    n : int
+        Number of sampling points to use when calculating the Gaussian weights
+        for BW averaging
+    scheme : str
+        'linspace' samples the Gaussian at n equally spaced points over
+        +/- truncate standard deviations. 'hermite' uses n-point
+        Gauss-Hermite quadrature, which reaches the same accuracy with
+        far fewer points for smooth attenuation curves (n = 8-12)
+    bounds : tuple
+        (E_min, E_max) of the tabulated data. Defaults to the range of E_vals
+
+    Returns
+    _______
+    Ep : (E_vals.size, n) ndarray
+        Row i contains the n energies averaged over for E_vals[i], clipped
+        to bounds
+    G : (n,) ndarray
+        Normalized Gaussian weights for each column of Ep
+    '''
+
+    x, G = _gaussian_nodes(n, truncate, scheme)
 
     # Gaussian standard deviations in keV, assuming FWHMs of E_vals*bw
     sd = E_vals * bw / (2*np.sqrt(2*np.log(2)))
 
-    # averaging neighborhood radii, in keV
-    r = truncate * sd
-
-    # Each row i is a linspace from (E_i-r_i) to (E_i+r_i)
-    Ep = np.array([np.linspace(E-w, E+w, n) for E, w in zip(E_vals, r)])
+    # Row i contains the nodes scaled to the Gaussian centered on E_i
+    Ep = E_vals[:, None] + sd[:, None] * x
 
     # Boundaries are handles by padding with E_min and E_max
-    Ep[(Ep - E_vals.min()) < 0] = E_vals.min()
-    Ep[(Ep - E_vals.max()) > 0] = E_vals.max()
+    E_min, E_max = (E_vals.min(), E_vals.max()) if bounds is None else bounds
+    Ep[(Ep - E_min) < 0] = E_min
+    Ep[(Ep - E_max) > 0] = E_max
+
+    return Ep, G
+
+
+@lru_cache(maxsize=32)
+def _gaussian_nodes(n, truncate, scheme):
+    '''
+    Nodes, in units of standard deviation, and normalized weights for
+    averaging over a Gaussian. Cached per (n, truncate, scheme).
+    '''
+
+    if scheme == 'linspace':
+        # Calculates a n-length Gaussian kernel, with points
+        # ranging from minus to plus (truncate * standard deviation)
+        # (i.e., for sd=1, truncate=4: ranges from [-4,4]
+        x = np.linspace(-truncate, truncate, n)
+        G = np.exp(-0.5 * x**2)
+    elif scheme == 'hermite':
+        # Nodes and weights for the weight function exp(-t**2), rescaled
+        # to a unit normal distribution
+        t, G = np.polynomial.hermite.hermgauss(n)
+        x = np.sqrt(2) * t
+    else:
+        raise ValueError("scheme must be 'linspace' or 'hermite'")
+    G /= G.sum()
+
+    # Shared between callers through the cache
+    x.flags.writeable = False
+    G.flags.writeable = False
+    return x, G
+
+
+def log_resolution_factor(voxel_size, n_projections, conv=0.1,
+                          c_filter=1 / 12):
+    '''
+    Returns the log of the factor by which the Spanne noise model scales CNR
+    for a given voxel size and number of projections.
+
+    The variance of a reconstructed voxel is
+
+        var = c_filter * pi**2 / (m * h**2) * (1 / N)
+
+    for m projections over 180 degrees, voxel (detector pixel) size h in cm
+    and N photons per pixel per projection, where c_filter * h**-2 is the sum
+    of squared filter taps (c_filter = 1 / 12 for the Ram-Lak filter). CNR is
+    therefore scaled by sqrt(m * h**2 / (c_filter * pi**2)).
+
+    Parameters
+    __________
+    voxel_size : float or ndarray
+        Voxel size in material thickness units
+    n_projections : int or ndarray
+        Number of projections over 180 degrees
+    conv : float
+        Conversion factor from material thickness units to cm
+    c_filter : float
+        Variance factor of the reconstruction filter
+
+    Returns
+    _______
+    log_factor : ndarray
+        Broadcast over voxel_size and n_projections
+    '''
+
+    h = np.asarray(voxel_size, dtype=float) * conv
+    m = np.asarray(n_projections, dtype=float)
+    return 0.5 * np.log(m * h**2 / (c_filter * np.pi**2))
 
-    # Interpolated values for A along Ep
-    A_int = log_interp(E_vals, A, Ep)
 
-    # Summing over Ep for each E in E_vals
-    N = I0 * (G * np.exp(-A_int)).sum(axis=-1)
+def window_indices(E_vals, E_window=None, step=1):
+    '''
+    Returns the indices of the energies at which cnrgui.util.cnr calculates
+    CNR for a given energy window and step.
+
+    Parameters
+    __________
+    E_vals : ndarray
+        Sampled energy values
+    E_window : tuple
+        (E_min, E_max) in keV. Defaults to all energies
+    step : int
+        Keeps every step-th energy in the window, and the last one
+
+    Returns
+    _______
+    idx : ndarray
+        Indices into E_vals. Includes the nearest energy on each side of
+        the window, so that a curve reaches the window edges and is never
+        empty, even for a window between two sampled energies
+    '''
 
-    return N.round(16)
+    if E_window is None:
+        idx = np.arange(E_vals.size)
+    else:
+        lo = max(np.searchsorted(E_vals, E_window[0], side='right') - 1, 0)
+        hi = min(np.searchsorted(E_vals, E_window[1]), E_vals.size - 1)
+        idx = np.arange(lo, max(hi, lo) + 1)
+    if idx.size and (idx.size - 1) % step:
+        return np.append(idx[::step], idx[-1])
+    return idx[::step]
@@ -0,0 +1,57 @@
+from cnrgui.material import Material
+from cnrgui.util import cnr, match_energies
+from timeit import timeit
+import numpy as np
+import matplotlib.pyplot as plt
+
+# Compares the accuracy and speed of the BW averaging schemes in
+# cnrgui.util.get_bw_samples. The reference is the linspace scheme with
+# many more points than the default n=50.
+
+H2O = Material('H2O',
+               thickness=2,
+               density=1)
+Os = Material('Os',
+              thickness=0.1,
+              density=0.05)
+match_energies(H2O, Os)
+
+bw = 1e-2
+ref = cnr(H2O, Os, bw=bw, n=2001)
+
+
+def rel_err(CNR):
+    err = np.abs(CNR - ref) / ref.max()
+    return err.max(), np.percentile(err, 90)
+
+
+print('{:<10s}{:>4s}{:>14s}{:>14s}{:>12s}'.format('scheme', 'n', 'max rel err',
+                                                  '90th pct', 'time [ms]'))
+errors = {}
+for scheme, ns in [('linspace', [8, 12, 20, 50, 100]),
+                   ('hermite', [4, 8, 12, 20, 50])]:
+    errors[scheme] = []
+    for n in ns:
+        CNR = cnr(H2O, Os, bw=bw, n=n, scheme=scheme)
+        t = timeit(lambda: cnr(H2O, Os, bw=bw, n=n, scheme=scheme),
+                   number=20) / 20
+        errors[scheme].append(rel_err(CNR))
+        print('{:<10s}{:>4d}{:>14.2e}{:>14.2e}{:>12.2f}'.format(
+            scheme, n, errors[scheme][-1][0], errors[scheme][-1][1], t * 1e3))
+
+# Gauss-Hermite is exact for smooth integrands, but the interpolated
+# attenuation is only piecewise linear in log-log space and jumps at the
+# absorption edges. Both schemes therefore converge slowly near the edges,
+# which dominate the maximum error.
+plt.figure(figsize=(10, 6))
+for scheme, n in [('linspace', 50), ('hermite', 10)]:
+    CNR = cnr(H2O, Os, bw=bw, n=n, scheme=scheme)
+    plt.semilogy(H2O.E, np.abs(CNR - ref) / ref.max(),
+                 label='{}, n={}'.format(scheme, n))
+plt.xlabel('E [keV]')
+plt.ylabel('|CNR - CNR$_{ref}$| / max(CNR$_{ref}$)')
+plt.title('BW averaging error, BW={:.0e}'.format(bw))
+plt.legend()
+plt.grid(True)
+plt.tight_layout()
+plt.savefig('quadrature_error.png', dpi=150)
@@ -16,6 +16,6 @@ setup(name='cnrgui',
       license='MIT',
       packages=['cnrgui'],
       package_dir={'cnrgui': 'cnrgui'},
-      package_data={'cnrgui': ['atten_data/*']},
+      package_data={'cnrgui': ['atten_data/*', 'golden_data/*']},
       install_requires=['numpy', 'matplotlib', 'scipy'],
       zip_safe=False)